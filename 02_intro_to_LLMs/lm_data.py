@@ -0,0 +1,391 @@
+# Data loading for the character level language model of 03_languagemodels.ipynb
+#
+#   python lm_data.py benchmark            # benchmark the batch samplers on dataset/input.txt
+#   python lm_data.py benchmark --batch-sizes 16,256 --block-sizes 32,1024
+#   python lm_data.py codec                # round trip checks and speed of CharCodec
+#   python lm_data.py encode dataset/input.txt --out dataset/input.bin --val-fraction 0.1
+#   python lm_data.py encode --split train=dataset/train_input.txt --split test=dataset/test_input.txt --out dataset/tokens.bin
+from __future__ import print_function
+import io
+import json
+import time
+import struct
+import argparse
+from collections import OrderedDict
+
+import numpy
+import torch
+
+MAGIC = b'LMTOKENS'
+ALIGN = 64
+
+
+class CharCodec(object):
+    """ Character level tokenizer with lookup tables instead of a dict lookup per character.
+
+    encode maps the code points of the text (numpy.frombuffer of its UTF-32
+    encoding) through a table indexed by code point; decode maps the ids
+    back to code points and decodes them in one go. When all the characters
+    are below 256 (e.g. the 65 characters of tiny Shakespeare) the text is
+    encoded as latin-1 and mapped with bytes.translate instead, one byte per
+    character. Characters outside the vocabulary raise a KeyError.
+    """
+
+    def __init__(self, chars):
+        self.chars = list(chars)
+        self.codepoints = numpy.array([ord(c) for c in self.chars], dtype=numpy.uint32)
+        self.table = numpy.full(int(self.codepoints.max()) + 1, -1, dtype=numpy.int64)
+        self.table[self.codepoints] = numpy.arange(len(self.chars))
+        self.byte_tables = None
+        if len(self.chars) < 256 and self.codepoints.max() < 256:
+            # 255 is never a valid id here and marks unknown characters
+            encode_table = numpy.full(256, 255, dtype=numpy.uint8)
+            encode_table[self.codepoints] = numpy.arange(len(self.chars))
+            decode_table = numpy.zeros(256, dtype=numpy.uint8)
+            decode_table[:len(self.chars)] = self.codepoints
+            self.byte_tables = (encode_table.tobytes(), decode_table.tobytes())
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(sorted(set(text)))
+
+    @property
+    def vocab_size(self):
+        return len(self.chars)
+
+    def encode(self, text):
+        """ numpy array of the token ids of text """
+        if self.byte_tables is not None:
+            try:
+                ids = numpy.frombuffer(text.encode('latin-1').translate(self.byte_tables[0]), dtype=numpy.uint8)
+            except UnicodeEncodeError:
+                ids = None
+            if ids is not None:
+                if len(ids) and ids.max() == 255:
+                    raise KeyError(text[int(numpy.argmax(ids == 255))])
+                return ids.astype(numpy.int64)
+        codepoints = numpy.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+        known = codepoints < len(self.table)
+        ids = self.table[numpy.where(known, codepoints, 0)]
+        bad = ~known | (ids < 0)
+        if bad.any():
+            raise KeyError(text[int(numpy.argmax(bad))])
+        return ids
+
+    def decode(self, ids):
+        """ Text of a sequence of token ids (list, numpy array or tensor) """
+        if isinstance(ids, torch.Tensor):
+            ids = ids.cpu().numpy()
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        if self.byte_tables is not None:
+            return ids.astype(numpy.uint8).tobytes().translate(self.byte_tables[1]).decode('latin-1')
+        return self.codepoints[ids].astype('<u4').tobytes().decode('utf-32-le')
+
+
+def get_batch_reference(data, block_size, batch_size):
+    """ get_batch of the notebook: one slice per row and two stacks """
+    ix = torch.randint(len(data) - block_size, (batch_size,))
+    x = torch.stack([data[i:i+block_size] for i in ix])
+    y = torch.stack([data[i+1:i+block_size+1] for i in ix])
+    return x, y
+
+
+class BatchSampler(object):
+    """ Random (x, y) training windows of a 1-D tensor of tokens.
+
+    data.unfold gives a zero-copy (len(data) - block_size, block_size + 1) view
+    of all the windows, so a batch is a single gather of batch_size rows of
+    block_size + 1 tokens: x is the first block_size columns and y the last
+    block_size (both are views of the gathered rows, use reshape rather than
+    view on them). With out_buffers the rows are gathered into preallocated
+    buffers, pinned when copying to a GPU so that the copy is asynchronous.
+    On the CPU a batch is then a view of a buffer that the next call
+    overwrites: only for loops that are done with a batch before drawing the
+    next one, such as a training step.
+
+    data can also be a numpy array, e.g. a split of a TokenStore: the windows
+    are then a sliding_window_view of the memory map and only the pages of the
+    sampled windows are read.
+    """
+
+    def __init__(self, data, block_size, batch_size, device='cpu', out_buffers=False, generator=None):
+        self.data = data
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.generator = generator
+        if isinstance(data, numpy.ndarray):
+            self.windows = numpy.lib.stride_tricks.sliding_window_view(data, block_size + 1)
+            dtype = torch.long
+        else:
+            self.windows = data.unfold(0, block_size + 1, 1)
+            dtype = data.dtype
+        self.buffers = []
+        self.events = []
+        if out_buffers:
+            pin = self.device.type == 'cuda'
+            # two buffers: one can be filled while the copy of the other is in flight
+            for __ in range(2 if pin else 1):
+                self.buffers.append(torch.empty((batch_size, block_size + 1), dtype=dtype, pin_memory=pin))
+                self.events.append(torch.cuda.Event() if pin else None)
+        self.step = 0
+
+    def __call__(self):
+        ix = torch.randint(len(self.windows), (self.batch_size,), generator=self.generator)
+        if isinstance(self.windows, numpy.ndarray):
+            rows = torch.from_numpy(self.windows[ix.numpy()].astype(numpy.int64))
+            k = None
+            if self.buffers:
+                k = self.step % len(self.buffers)
+                if self.events[k] is not None:
+                    self.events[k].synchronize()
+                rows = self.buffers[k].copy_(rows)
+        elif self.buffers:
+            k = self.step % len(self.buffers)
+            if self.events[k] is not None:
+                self.events[k].synchronize()
+            rows = torch.index_select(self.windows, 0, ix, out=self.buffers[k])
+        else:
+            k = None
+            rows = self.windows[ix]
+        self.step += 1
+        if self.device.type != 'cpu':
+            rows = rows.to(self.device, non_blocking=True)
+            if k is not None and self.events[k] is not None:
+                self.events[k].record()
+        return rows[:, :-1], rows[:, 1:]
+
+    def __iter__(self):
+        while True:
+            yield self()
+
+
+def token_dtype(vocab_size):
+    """ Smallest unsigned integer type holding all the token ids """
+    for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+        if vocab_size <= numpy.iinfo(dtype).max + 1:
+            return numpy.dtype(dtype)
+    raise ValueError('vocabulary too large')
+
+
+def write_token_store(path, vocab, splits):
+    """ Write the token store path.
+
+    vocab is the list of tokens (index = token id) and splits an ordered
+    mapping of split name to an iterable of token id arrays, consumed one
+    chunk at a time so that the corpus never has to fit in memory. The file
+    is a header (magic, header length, JSON with vocab, dtype and the
+    [start, end) token offsets of every split) padded to a multiple of 64
+    bytes, followed by the token ids of all the splits.
+    """
+    dtype = token_dtype(len(vocab))
+
+    def header(offsets, n):
+        return json.dumps({'vocab': list(vocab), 'dtype': dtype.name, 'splits': offsets,
+                           'num_tokens': n}).encode('utf-8')
+
+    # room for the final offsets, which are only known at the end
+    reserved = len(header(OrderedDict((name, [2**63, 2**63]) for name in splits), 2**63))
+    reserved += -(len(MAGIC) + 8 + reserved) % ALIGN
+    with open(path, 'wb') as f:
+        f.seek(len(MAGIC) + 8 + reserved)
+        offsets = OrderedDict()
+        n = 0
+        for name, chunks in splits.items():
+            start = n
+            for chunk in chunks:
+                chunk = numpy.asarray(chunk)
+                if len(chunk) and chunk.max() >= len(vocab):
+                    raise ValueError('token id %d outside the vocabulary' % chunk.max())
+                chunk.astype(dtype).tofile(f)
+                n += len(chunk)
+            offsets[name] = [start, n]
+        f.seek(0)
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', reserved))
+        f.write(header(offsets, n).ljust(reserved))
+
+
+class TokenStore(object):
+    """ Read only, memory mapped view of a file written by write_token_store """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a token store' % path)
+            (length,) = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(length).decode('utf-8'))
+        self.path = path
+        self.vocab = header['vocab']
+        self.dtype = numpy.dtype(header['dtype'])
+        self.offsets = header['splits']
+        self.tokens = numpy.memmap(path, dtype=self.dtype, mode='r', offset=len(MAGIC) + 8 + length,
+                                   shape=(header['num_tokens'],))
+
+    @property
+    def vocab_size(self):
+        return len(self.vocab)
+
+    @property
+    def splits(self):
+        return list(self.offsets)
+
+    def __getitem__(self, split):
+        start, end = self.offsets[split]
+        return self.tokens[start:end]
+
+
+def read_chunks(path, start=0, end=None, chunk_chars=1 << 24):
+    """ Characters start to end of the text file path, chunk_chars at a time """
+    with io.open(path, 'r', encoding='utf-8', newline='') as f:
+        pos = 0
+        while end is None or pos < end:
+            chunk = f.read(chunk_chars)
+            if not chunk:
+                return
+            lo, hi = max(start - pos, 0), len(chunk) if end is None else min(end - pos, len(chunk))
+            pos += len(chunk)
+            if lo < hi:
+                yield chunk[lo:hi]
+
+
+def encode_text_files(out, split_files, val_fraction=0.0):
+    """ Character level token store of text files: split_files maps split name to file.
+
+    With a single file and val_fraction > 0, the file is split into 'train'
+    and 'val' like in the notebook (first 1 - val_fraction of the characters
+    for training). The files are read twice (vocabulary, then encoding), one
+    chunk at a time.
+    """
+    chars = set()
+    counts = {}
+    for name, path in split_files.items():
+        counts[name] = 0
+        for chunk in read_chunks(path):
+            chars.update(chunk)
+            counts[name] += len(chunk)
+    codec = CharCodec(sorted(chars))
+
+    def encode(path, start=0, end=None):
+        for chunk in read_chunks(path, start, end):
+            yield codec.encode(chunk)
+
+    if len(split_files) == 1 and val_fraction > 0:
+        ((name, path),) = split_files.items()
+        n = int((1 - val_fraction) * counts[name])
+        splits = OrderedDict([('train', encode(path, 0, n)), ('val', encode(path, n))])
+    else:
+        splits = OrderedDict((name, encode(path)) for name, path in split_files.items())
+    write_token_store(out, codec.chars, splits)
+    return TokenStore(out)
+
+
+def _time(fn, repeat):
+    fn()
+    t0 = time.time()
+    for __ in range(repeat):
+        fn()
+    return (time.time() - t0) / repeat
+
+
+def benchmark(args):
+    with open(args.input, 'r', encoding='utf-8') as f:
+        text = f.read()
+    data = torch.from_numpy(CharCodec.from_text(text).encode(text))
+    store = None
+    if args.store is not None:
+        store = TokenStore(args.store)
+
+    print('%6s %6s %14s %14s %8s %14s' % ('batch', 'block', 'reference(ms)', 'sampler(ms)', 'speedup', 'memmap(ms)'))
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        for block_size in [int(b) for b in args.block_sizes.split(',')]:
+            sampler = BatchSampler(data, block_size, batch_size, out_buffers=True)
+            x, y = sampler()
+            assert torch.equal(x[:, 1:], y[:, :-1])
+            t_ref = _time(lambda: get_batch_reference(data, block_size, batch_size), args.repeat)
+            t_new = _time(sampler, args.repeat)
+            t_map = _time(BatchSampler(store[store.splits[0]], block_size, batch_size, out_buffers=True), args.repeat) \
+                if store is not None else float('nan')
+            print('%6d %6d %14.3f %14.3f %8.1f %14.3f' % (batch_size, block_size, 1e3 * t_ref, 1e3 * t_new,
+                                                          t_ref / t_new, 1e3 * t_map))
+
+
+def codec(args):
+    texts = OrderedDict()
+    for path in args.inputs:
+        with open(path, 'r', encoding='utf-8') as f:
+            texts[path] = f.read()
+    texts['non latin-1 sample'] = u'Wherefore art thou \u03c1\u03c9\u03bc\u03b5\u03bf, \u7f57\u5bc6\u6b27 \U0001f339?\n' * 1000
+
+    print('%-28s %10s %14s %12s %14s %12s' % ('text', 'chars', 'dict enc (ms)', 'enc (ms)', 'dict dec (ms)', 'dec (ms)'))
+    for name, text in texts.items():
+        chars = sorted(set(text))
+        stoi = {ch: i for i, ch in enumerate(chars)}
+        itos = {i: ch for i, ch in enumerate(chars)}
+        table = CharCodec(chars)
+        # round trip and agreement with the dict based codec of the notebook
+        reference = [stoi[c] for c in text]
+        ids = table.encode(text)
+        assert ids.tolist() == reference
+        assert table.decode(ids) == text
+        assert table.decode(torch.from_numpy(ids)) == text
+        assert table.decode(ids.tolist()) == text
+        assert table.encode('').size == 0 and table.decode([]) == ''
+        t_dict_enc = _time(lambda: [stoi[c] for c in text], args.repeat)
+        t_enc = _time(lambda: table.encode(text), args.repeat)
+        t_dict_dec = _time(lambda: ''.join([itos[i] for i in reference]), args.repeat)
+        t_dec = _time(lambda: table.decode(ids), args.repeat)
+        print('%-28s %10d %14.2f %12.2f %14.2f %12.2f' % (name[-28:], len(text), 1e3 * t_dict_enc, 1e3 * t_enc,
+                                                          1e3 * t_dict_dec, 1e3 * t_dec))
+    # characters outside the vocabulary
+    for text in [u'\u00e9', u'\u4e00', u'\x00']:
+        try:
+            CharCodec.from_text('abc').encode('ab' + text)
+            raise AssertionError('unknown character %r was encoded' % text)
+        except KeyError:
+            pass
+    print('round trips OK')
+
+
+def encode(args):
+    split_files = OrderedDict(s.split('=', 1) for s in args.split)
+    if args.input is not None:
+        split_files['train'] = args.input
+    t0 = time.time()
+    store = encode_text_files(args.out, split_files, args.val_fraction)
+    print('%s: %d tokens, vocab %d, %s, written in %.2f s' % (
+        args.out, len(store.tokens), store.vocab_size, store.dtype, time.time() - t0))
+    for name in store.splits:
+        print('  %-8s %10d tokens' % (name, len(store[name])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Language model data utilities',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('benchmark', help='compare the batch samplers',
+                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--input', default='dataset/input.txt')
+    p.add_argument('--store', default=None, help='also sample from the first split of this token store')
+    p.add_argument('--batch-sizes', default='16,64,256')
+    p.add_argument('--block-sizes', default='32,256,1024')
+    p.add_argument('--repeat', default=20, type=int)
+    p = sub.add_parser('codec', help='check and time CharCodec against the dict based codec',
+                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('inputs', nargs='*', default=['dataset/input.txt', 'dataset/train_input.txt', 'dataset/test_input.txt'])
+    p.add_argument('--repeat', default=3, type=int)
+    p = sub.add_parser('encode', help='write a character level token store',
+                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('input', nargs='?', default=None, help='text file (split train, or train/val with --val-fraction)')
+    p.add_argument('--split', action='append', default=[], help='name=file, may be repeated')
+    p.add_argument('--val-fraction', default=0.0, type=float)
+    p.add_argument('--out', required=True)
+    args = parser.parse_args()
+    if args.command == 'encode':
+        encode(args)
+    elif args.command == 'codec':
+        codec(args)
+    else:
+        if args.command is None:
+            args = parser.parse_args(['benchmark'])
+        benchmark(args)
@@ -0,0 +1,240 @@
+# Evaluation of the character level language model of 03_languagemodels.ipynb:
+# a fixed set of windows per split, evaluated in large inference_mode batches,
+# the loss reported with a confidence interval, and a schedule that evaluates
+# less often once the validation loss stops moving.
+#
+#   python lm_eval.py                      # train, evaluating with both estimate_loss and Evaluator
+#   python lm_eval.py --max-iters 2000 --eval-interval 10 --attention sdpa
+#
+# In a training loop:
+#   evaluator = Evaluator(model, {'train': train_data, 'val': val_data}, block_size)
+#   schedule = EvalSchedule(eval_interval)
+#   for it in range(max_iters):
+#       if schedule.due(it) or it == max_iters - 1:
+#           losses = evaluator()
+#           schedule.update(it, losses['val'])
+#           print(f"step {it}: train loss {losses['train']}, val loss {losses['val']}")
+from __future__ import print_function
+import math
+import time
+import argparse
+from collections import OrderedDict
+
+import torch
+from torch.nn import functional as F
+
+
+class EvalSet(object):
+    """ a fixed set of (x, y) windows of a 1-D tensor of tokens
+
+    num_windows windows at evenly spaced offsets over the whole split, in an
+    order shuffled once with a seeded generator, so that every evaluation
+    sees the same windows and any prefix of them is a random sample of the
+    split. They are gathered once into a (num_windows, block_size + 1) tensor.
+    """
+
+    def __init__(self, data, block_size, num_windows, device='cpu', seed=1337):
+        data = torch.as_tensor(data, dtype=torch.long)
+        last = len(data) - block_size - 1
+        num_windows = min(num_windows, last + 1)
+        ix = torch.linspace(0, last, num_windows).long()
+        ix = ix[torch.randperm(num_windows, generator=torch.Generator().manual_seed(seed))]
+        self.rows = data[ix[:, None] + torch.arange(block_size + 1)].to(device)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def batches(self, batch_size):
+        for i in range(0, len(self.rows), batch_size):
+            rows = self.rows[i:i + batch_size]
+            yield rows[:, :-1], rows[:, 1:]
+
+
+class LossEstimate(object):
+    """ running mean and variance of per window losses, with a normal confidence interval on the mean """
+
+    def __init__(self, z=1.96):
+        self.z = z
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, losses):
+        # merge the mean and sum of squared deviations of a batch (Chan et al.)
+        losses = losses.double()
+        n, mean = losses.numel(), losses.mean().item()
+        m2 = ((losses - mean) ** 2).sum().item()
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    @property
+    def ci(self):
+        """ half width of the confidence interval """
+        if self.n < 2:
+            return float('inf')
+        return self.z * math.sqrt(self.m2 / (self.n - 1) / self.n)
+
+    def __float__(self):
+        return self.mean
+
+    def __format__(self, spec):
+        return '%.4f +- %.4f' % (self.mean, self.ci)
+
+    def __str__(self):
+        return format(self)
+
+
+def window_losses(model, x, y):
+    """ mean cross entropy of every window (B,); model(x) returns (logits, loss) as in the notebook """
+    logits = model(x)[0]
+    losses = F.cross_entropy(logits.reshape(-1, logits.shape[-1]).float(), y.reshape(-1), reduction='none')
+    return losses.view(y.shape).mean(dim=1)
+
+
+class Evaluator(object):
+    """ estimate_loss on fixed EvalSets of every split, in batches of batch_size windows
+
+    Called, it returns a LossEstimate per split. With ci_target the
+    evaluation of a split stops after the batch where the confidence interval
+    is narrower than that.
+    """
+
+    def __init__(self, model, splits, block_size, num_windows=1024, batch_size=512, ci_target=None, device='cpu'):
+        self.model = model
+        self.sets = OrderedDict((name, EvalSet(data, block_size, num_windows, device)) for name, data in splits.items())
+        self.batch_size = batch_size
+        self.ci_target = ci_target
+
+    @torch.inference_mode()
+    def __call__(self):
+        training = self.model.training
+        self.model.eval()
+        out = OrderedDict()
+        for name, evalset in self.sets.items():
+            estimate = LossEstimate()
+            for x, y in evalset.batches(self.batch_size):
+                estimate.update(window_losses(self.model, x, y))
+                if self.ci_target is not None and estimate.ci < self.ci_target:
+                    break
+            out[name] = estimate
+        self.model.train(training)
+        return out
+
+
+class EvalSchedule(object):
+    """ evaluate every interval steps, less often while the loss is stable
+
+    After an evaluation whose loss moved by no more than tolerance (by
+    default its confidence interval) since the previous one, the interval
+    doubles, up to max_interval; when the loss moves more, it goes back to
+    interval.
+    """
+
+    def __init__(self, interval, max_interval=None, tolerance=None):
+        self.base = interval
+        self.interval = interval
+        self.max_interval = 16 * interval if max_interval is None else max_interval
+        self.tolerance = tolerance
+        self.last = None
+        self.next = 0
+
+    def due(self, step):
+        return step >= self.next
+
+    def update(self, step, estimate):
+        if self.last is not None:
+            tolerance = estimate.ci if self.tolerance is None else self.tolerance
+            if abs(float(estimate) - self.last) <= tolerance:
+                self.interval = min(2 * self.interval, self.max_interval)
+            else:
+                self.interval = self.base
+        self.last = float(estimate)
+        self.next = step + self.interval
+
+
+if __name__ == '__main__':
+    from lm_data import BatchSampler, CharCodec
+    from lm_model import LanguageModel, ATTENTION
+
+    parser = argparse.ArgumentParser(description='Notebook estimate_loss vs Evaluator and EvalSchedule during training',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input', default='dataset/input.txt')
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--block-size', default=32, type=int)
+    parser.add_argument('--max-iters', default=500, type=int)
+    parser.add_argument('--eval-interval', default=10, type=int)
+    parser.add_argument('--eval-iters', default=200, type=int, help='random batches per split of estimate_loss')
+    parser.add_argument('--eval-windows', default=1024, type=int, help='fixed windows per split of Evaluator')
+    parser.add_argument('--eval-batch-size', default=512, type=int)
+    parser.add_argument('--learning-rate', default=1e-3, type=float)
+    parser.add_argument('--attention', default='sdpa', choices=list(ATTENTION))
+    args = parser.parse_args()
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        text = f.read()
+    codec = CharCodec.from_text(text)
+    data = torch.from_numpy(codec.encode(text))
+    n = int(0.9 * len(data))
+    splits = OrderedDict([('train', data[:n]), ('val', data[n:])])
+
+    torch.manual_seed(1337)
+    model = LanguageModel(codec.vocab_size, block_size=args.block_size, attention=args.attention)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=args.learning_rate)
+    # training draws its batches from its own generator, so evaluating does not change the run;
+    # every batch is done with before the next is drawn, so the samplers reuse their buffers
+    sampler = BatchSampler(splits['train'], args.block_size, args.batch_size, out_buffers=True,
+                           generator=torch.Generator().manual_seed(0))
+    eval_samplers = {name: BatchSampler(split, args.block_size, args.batch_size, out_buffers=True)
+                     for name, split in splits.items()}
+
+    @torch.no_grad()
+    def estimate_loss():
+        # the notebook's: eval_iters fresh random batches per split
+        out = {}
+        model.eval()
+        for split in ['train', 'val']:
+            losses = torch.zeros(args.eval_iters)
+            for k in range(args.eval_iters):
+                X, Y = eval_samplers[split]()
+                logits, loss = model(X, Y)
+                losses[k] = loss.item()
+            out[split] = losses.mean()
+        model.train()
+        return out
+
+    evaluator = Evaluator(model, splits, args.block_size, args.eval_windows, args.eval_batch_size)
+    schedule = EvalSchedule(args.eval_interval)
+    times = {'train': 0.0, 'estimate_loss': 0.0, 'Evaluator': 0.0}
+    counts = {'estimate_loss': 0, 'Evaluator': 0}
+    print('%6s %-14s %10s %24s' % ('step', 'evaluation', 'time (s)', 'val loss'))
+    for it in range(args.max_iters):
+        last = it == args.max_iters - 1
+        if it % args.eval_interval == 0 or last:
+            t0 = time.time()
+            losses = estimate_loss()
+            times['estimate_loss'] += time.time() - t0
+            counts['estimate_loss'] += 1
+            print('%6d %-14s %10.3f %24.4f' % (it, 'estimate_loss', time.time() - t0, losses['val']))
+        if schedule.due(it) or last:
+            t0 = time.time()
+            losses = evaluator()
+            schedule.update(it, losses['val'])
+            times['Evaluator'] += time.time() - t0
+            counts['Evaluator'] += 1
+            print('%6d %-14s %10.3f %24s' % (it, 'Evaluator', time.time() - t0, losses['val']))
+
+        t0 = time.time()
+        xb, yb = sampler()
+        logits, loss = model(xb, yb)
+        optimizer.zero_grad(set_to_none=True)
+        loss.backward()
+        optimizer.step()
+        times['train'] += time.time() - t0
+
+    print('\n%d training steps in %.1f s' % (args.max_iters, times['train']))
+    for name in ['estimate_loss', 'Evaluator']:
+        print('%-14s %4d evaluations in %7.1f s (%.0f%% of the training time)' % (
+            name, counts[name], times[name], 100 * times[name] / times['train']))
@@ -0,0 +1,150 @@
+# Memory accounting of the language model of lm_model.py, per module: the
+# parameters, their gradients, the optimizer state and the activations saved
+# for the backward pass of one batch, to size a run before launching it.
+#
+#   python lm_memory.py                                       # the notebook model
+#   python lm_memory.py --vocab-size 50257 --n-embd 768 --n-head 12 --n-layer 12 --block-size 1024 --batch-size 8
+#   python lm_memory.py --vocab-size 50257 --n-embd 768 --n-head 12 --n-layer 12 --tie-weights
+#   python lm_memory.py --device cpu --dtype bf16 --measure  # bf16 activations, and the measured peak of a step
+#
+# The default device is meta: the model and the batch have shapes but no
+# storage, so any size can be accounted for on a laptop. Autocast does not
+# apply to meta tensors, use --device cpu for bf16 activations.
+from __future__ import print_function
+import argparse
+from collections import OrderedDict
+
+import torch
+
+from lm_model import LanguageModel, ATTENTION, peak_memory
+
+# optimizer state per parameter element, in units of the parameter size
+OPTIMIZER_STATE = OrderedDict([('adamw', 2), ('sgd', 1), ('none', 0)])
+COLUMNS = ['params', 'grads', 'optimizer', 'activations']
+
+
+def _group(name, depth):
+    return '.'.join(name.split('.')[:depth]) if name else '(loss)'
+
+
+def memory_report(model, batch_size, block_size, optimizer='adamw', dtype=None, depth=3):
+    """ bytes of parameters, gradients, optimizer state and saved activations, per module
+
+    Modules are grouped by the first depth parts of their names (blocks.0.sa,
+    blocks.0.ffwd, ...). A tied parameter counts once, for the module that
+    registered it first. Activations are the tensors autograd saves for the
+    backward pass of a forward of a (batch_size, block_size) batch, counted
+    once per storage and for the innermost module running when they were saved;
+    what the loss saves is '(loss)'.
+    """
+    rows = OrderedDict()
+
+    def row(name):
+        return rows.setdefault(_group(name, depth), OrderedDict((c, 0) for c in COLUMNS))
+
+    parameters = {}
+    for name, p in model.named_parameters():
+        parameters[id(p)] = p
+        r = row(name.rsplit('.', 1)[0])
+        nbytes = p.numel() * p.element_size()
+        r['params'] += nbytes
+        if p.requires_grad:
+            r['grads'] += nbytes
+            r['optimizer'] += OPTIMIZER_STATE[optimizer] * nbytes
+
+    # the innermost module running, from forward pre and post hooks
+    stack = ['']
+
+    def enter(name):
+        return lambda module, inputs: stack.append(name)
+
+    def leave(module, inputs, output):
+        stack.pop()
+
+    handles = []
+    for name, module in model.named_modules():
+        if name:
+            handles.append(module.register_forward_pre_hook(enter(name)))
+            handles.append(module.register_forward_hook(leave))
+    seen = set()
+    keep = []
+
+    def pack(t):
+        base = t if t._base is None else t._base
+        if id(base) not in seen and id(base) not in parameters:
+            seen.add(id(base))
+            keep.append(base) # so that ids are not reused
+            row(stack[-1])['activations'] += base.numel() * base.element_size()
+        return t
+
+    device = next(model.parameters()).device
+    idx = torch.zeros(batch_size, block_size, dtype=torch.long, device=device)
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            with torch.autocast('cpu' if device.type == 'meta' else device.type, dtype=dtype,
+                                enabled=dtype is not None and device.type != 'meta'):
+                model(idx, idx)
+    finally:
+        for h in handles:
+            h.remove()
+    return rows
+
+
+def print_report(rows):
+    print('%-28s' % 'module' + ''.join('%14s' % c for c in COLUMNS) + '%14s' % 'total')
+    totals = OrderedDict((c, 0) for c in COLUMNS)
+    for name, r in rows.items():
+        for c in COLUMNS:
+            totals[c] += r[c]
+        print('%-28s' % name + ''.join('%14.2f' % (r[c] / 2**20) for c in COLUMNS) + '%14.2f' % (sum(r.values()) / 2**20))
+    print('%-28s' % 'total' + ''.join('%14.2f' % (totals[c] / 2**20) for c in COLUMNS) +
+          '%14.2f' % (sum(totals.values()) / 2**20))
+    print('(MiB)')
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory accounting of the language model per module',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--vocab-size', default=65, type=int)
+    parser.add_argument('--n-embd', default=64, type=int)
+    parser.add_argument('--n-head', default=4, type=int)
+    parser.add_argument('--n-layer', default=4, type=int)
+    parser.add_argument('--block-size', default=32, type=int)
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--attention', default='sdpa', choices=list(ATTENTION))
+    parser.add_argument('--tie-weights', action='store_true', help='share the token embedding and the output head')
+    parser.add_argument('--optimizer', default='adamw', choices=list(OPTIMIZER_STATE))
+    parser.add_argument('--dtype', default='fp32', choices=['fp32', 'bf16'], help='autocast dtype of the forward')
+    parser.add_argument('--depth', default=3, type=int, help='module name parts to group by')
+    parser.add_argument('--device', default='meta', choices=['meta', 'cpu', 'cuda'])
+    parser.add_argument('--measure', action='store_true',
+                        help='also run a training step and measure its peak memory (not on meta)')
+    args = parser.parse_args()
+    dtype = torch.bfloat16 if args.dtype == 'bf16' else None
+    device = torch.device(args.device)
+
+    with device:
+        model = LanguageModel(args.vocab_size, args.n_embd, args.n_head, args.n_layer, args.block_size,
+                              attention=args.attention, tie_weights=args.tie_weights)
+    print('%d parameters%s, batch %d x %d, %s, %s activations' % (
+        sum(p.numel() for p in model.parameters()), ' (tied embedding and head)' if args.tie_weights else '',
+        args.batch_size, args.block_size, args.optimizer, 'fp32' if device.type == 'meta' else args.dtype))
+    totals = print_report(memory_report(model, args.batch_size, args.block_size, args.optimizer, dtype, args.depth))
+
+    if args.measure and device.type != 'meta':
+        idx = torch.randint(args.vocab_size, (args.batch_size, args.block_size), device=device)
+        optimizer = torch.optim.AdamW(model.parameters()) if args.optimizer == 'adamw' else \
+            torch.optim.SGD(model.parameters(), lr=1e-3, momentum=0.9 if args.optimizer == 'sgd' else 0)
+
+        def step():
+            with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+                logits, loss = model(idx, idx)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+        # the first step allocates the optimizer state: account for it, then measure a step as in training
+        step()
+        peak = peak_memory(step, device)
+        print('measured peak of a training step above params and optimizer state: %.2f MiB '
+              '(accounted grads + activations: %.2f MiB)' % (peak / 2**20, (totals['grads'] + totals['activations']) / 2**20))
@@ -0,0 +1,579 @@
+# The mini-LLM of 03_languagemodels.ipynb as a module: the same classes with the
+# hyperparameters as constructor arguments instead of notebook globals, plus
+# faster drop-in variants of the attention.
+#
+#   python lm_model.py fused               # fused vs per-head attention: throughput and allocations
+#   python lm_model.py fused --configs 64x4,256x8,512x16 --device cuda
+#   python lm_model.py sdpa                # causal attention kernels: speed and peak memory vs block_size
+#   python lm_model.py generate            # per token latency of generate with and without the KV cache
+#
+# attention='heads' is the notebook's MultiHeadAttention (a ModuleList of Head
+# modules, one key/query/value Linear each, outputs concatenated with
+# torch.cat); attention='fused' is FusedMultiHeadAttention (one QKV Linear,
+# all the heads in one batched matmul). fuse_attention_state_dict converts the
+# weights of a model trained with the first to the second; attention='sdpa' is
+# the fused module with F.scaled_dot_product_attention and the same weights.
+# tie_weights=True shares the token embedding matrix with the output head and
+# scales the input of the head by n_embd**-0.5 (see LanguageModel).
+from __future__ import print_function
+import re
+import functools
+import time
+import argparse
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+
+class Head(nn.Module):
+    """ one head of self-attention """
+
+    def __init__(self, head_size, n_embd, block_size, dropout=0.0):
+        super().__init__()
+        self.key = nn.Linear(n_embd, head_size, bias=False)
+        self.query = nn.Linear(n_embd, head_size, bias=False)
+        self.value = nn.Linear(n_embd, head_size, bias=False)
+        self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size)))
+
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x):
+        B,T,C = x.shape
+        k = self.key(x)   # (B,T,hs)
+        q = self.query(x) # (B,T,hs)
+        # compute attention scores ("affinities")
+        wei = q @ k.transpose(-2,-1) * C**-0.5 # (B, T, hs) @ (B, hs, T) -> (B, T, T)
+        wei = wei.masked_fill(self.tril[:T, :T] == 0, float('-inf')) # (B, T, T)
+        wei = F.softmax(wei, dim=-1) # (B, T, T)
+        wei = self.dropout(wei)
+        # perform the weighted aggregation of the values
+        v = self.value(x) # (B,T,hs)
+        out = wei @ v # (B, T, T) @ (B, T, hs) -> (B, T, hs)
+        return out
+
+
+class MultiHeadAttention(nn.Module):
+    """ multiple heads of self-attention in parallel """
+
+    def __init__(self, num_heads, head_size, n_embd, block_size, dropout=0.0):
+        super().__init__()
+        self.heads = nn.ModuleList([Head(head_size, n_embd, block_size, dropout) for _ in range(num_heads)])
+        self.proj = nn.Linear(n_embd, n_embd)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x, cache=None, layer=None):
+        if cache is None:
+            out = torch.cat([h(x) for h in self.heads], dim=-1)
+        else:
+            B,T,C = x.shape
+            q, k, v = [torch.stack([getattr(h, name)(x) for h in self.heads], dim=1) # (B, nh, T, hs)
+                       for name in ('query', 'key', 'value')]
+            out = cache.attend(layer, q, k, v, C**-0.5).transpose(1, 2).reshape(B, T, C)
+        out = self.dropout(self.proj(out))
+        return out
+
+
+class FusedMultiHeadAttention(nn.Module):
+    """ multiple heads of self-attention as one QKV projection and batched matmuls
+
+    qkv.weight stacks the query, key and value weights of all the heads, in
+    that order: rows [s*n_embd + h*head_size, s*n_embd + (h+1)*head_size) are
+    head h of s = query, key, value. The scores are scaled by n_embd**-0.5 as
+    in Head, so the two give the same outputs with converted weights.
+
+    With sdpa=True the attention is F.scaled_dot_product_attention with
+    is_causal=True instead of the materialized, masked (B, nh, T, T) scores,
+    which stay as the reference implementation.
+    """
+
+    def __init__(self, num_heads, head_size, n_embd, block_size, dropout=0.0, sdpa=False):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_size = head_size
+        self.sdpa = sdpa
+        self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
+        if not sdpa:
+            self.register_buffer('tril', torch.tril(torch.ones(block_size, block_size, dtype=torch.bool)),
+                                 persistent=False)
+        self.attn_dropout = nn.Dropout(dropout)
+        self.proj = nn.Linear(num_heads * head_size, n_embd)
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x, cache=None, layer=None):
+        B,T,C = x.shape
+        # (B, T, 3*nh*hs) -> (3, B, nh, T, hs)
+        q, k, v = self.qkv(x).view(B, T, 3, self.num_heads, self.head_size).permute(2, 0, 3, 1, 4).unbind(0)
+        if cache is not None:
+            out = cache.attend(layer, q, k, v, C**-0.5)
+        elif self.sdpa:
+            # flash / memory efficient kernels where available: the (T, T) scores are never stored
+            out = F.scaled_dot_product_attention(q, k, v, is_causal=True, scale=C**-0.5,
+                                                 dropout_p=self.attn_dropout.p if self.training else 0.0)
+        else:
+            wei = q @ k.transpose(-2,-1) * C**-0.5 # (B, nh, T, T)
+            wei = wei.masked_fill(~self.tril[:T, :T], float('-inf'))
+            wei = F.softmax(wei, dim=-1)
+            wei = self.attn_dropout(wei)
+            out = wei @ v # (B, nh, T, hs)
+        out = out.transpose(1, 2).reshape(B, T, self.num_heads * self.head_size)
+        out = self.dropout(self.proj(out))
+        return out
+
+
+class KVCache(object):
+    """ keys and values of the last tokens for every layer, preallocated to block_size positions
+
+    LanguageModel.forward_cached feeds either the prompt (into an empty cache)
+    or one new token at a time; every attention module writes the keys and
+    values of the new tokens into its slots and attends over the cached ones,
+    so each new token costs one token's worth of compute. When the cache is
+    full the oldest slot is overwritten ('rolling'); the order of the slots
+    does not matter to the attention of a single query.
+    """
+
+    def __init__(self, n_layer, batch_size, num_heads, head_size, block_size, device=None, dtype=None):
+        self.block_size = block_size
+        self.kv = torch.zeros(n_layer, 2, batch_size, num_heads, block_size, head_size, device=device, dtype=dtype)
+        self.reset()
+
+    def reset(self):
+        self.length = 0 # number of cached tokens
+        self.slot = 0   # slot of the next token
+
+    def attend(self, layer, q, k, v, scale):
+        """ attention of the new tokens q, k, v (B, nh, T, hs) over the cache, after adding k and v to it """
+        T = q.shape[2]
+        keys, values = self.kv[layer]
+        if T > 1 and self.length > 0:
+            raise ValueError('several new tokens can only go into an empty cache')
+        if self.slot + T > self.block_size:
+            raise ValueError('%d tokens do not fit in a cache of %d' % (T, self.block_size))
+        keys[:, :, self.slot:self.slot + T] = k
+        values[:, :, self.slot:self.slot + T] = v
+        if T > 1:
+            return F.scaled_dot_product_attention(q, keys[:, :, :T], values[:, :, :T], is_causal=True, scale=scale)
+        n = min(self.length + 1, self.block_size)
+        return F.scaled_dot_product_attention(q, keys[:, :, :n], values[:, :, :n], scale=scale)
+
+    def advance(self, T):
+        self.length = min(self.length + T, self.block_size)
+        self.slot = (self.slot + T) % self.block_size
+
+
+ATTENTION = OrderedDict([('heads', MultiHeadAttention), ('fused', FusedMultiHeadAttention),
+                         ('sdpa', functools.partial(FusedMultiHeadAttention, sdpa=True))])
+
+
+def fuse_attention_state_dict(state_dict):
+    """ state dict of a model with MultiHeadAttention for the same model with FusedMultiHeadAttention
+
+    The key/query/value weights of the heads of every attention module are
+    stacked into its qkv.weight and the causal mask buffers are dropped;
+    everything else is kept as is. Works on the state dict of a whole
+    LanguageModel, of a Block or of one attention module.
+    """
+    head_re = re.compile(r'^(.*)heads\.(\d+)\.(key\.weight|query\.weight|value\.weight|tril)$')
+    fused = OrderedDict()
+    heads = OrderedDict()
+    for name, tensor in state_dict.items():
+        m = head_re.match(name)
+        if m is None:
+            fused[name] = tensor
+            continue
+        prefix, h, kind = m.group(1), int(m.group(2)), m.group(3).split('.')[0]
+        if kind != 'tril':
+            heads.setdefault(prefix, {})[(kind, h)] = tensor
+            # keep the parameter order: qkv where the first head was
+            fused.setdefault(prefix + 'qkv.weight', None)
+    for prefix, weights in heads.items():
+        n = max(h for __, h in weights) + 1
+        fused[prefix + 'qkv.weight'] = torch.cat([weights[(kind, h)] for kind in ('query', 'key', 'value')
+                                                  for h in range(n)], dim=0)
+    return fused
+
+
+class FeedFoward(nn.Module):
+    """ a simple linear layer followed by a non-linearity """
+
+    def __init__(self, n_embd, dropout=0.0):
+        super().__init__()
+        self.net = nn.Sequential(
+            nn.Linear(n_embd, 4 * n_embd),
+            nn.ReLU(),
+            nn.Linear(4 * n_embd, n_embd), # Projection layer going back into the residual pathway
+            nn.Dropout(dropout),
+        )
+
+    def forward(self, x):
+        return self.net(x)
+
+
+class Block(nn.Module):
+    """ Transformer block: communication followed by computation """
+
+    def __init__(self, n_embd, n_head, block_size, dropout=0.0, attention='heads'):
+        # n_embd: embedding dimension, n_head: the number of heads we'd like
+        super().__init__()
+        head_size = n_embd // n_head
+        self.sa = ATTENTION[attention](n_head, head_size, n_embd, block_size, dropout)
+        self.ffwd = FeedFoward(n_embd, dropout)
+        self.ln1 = nn.LayerNorm(n_embd)
+        self.ln2 = nn.LayerNorm(n_embd)
+
+    def forward(self, x, cache=None, layer=None):
+        x = x + self.sa(self.ln1(x), cache, layer) # Communication
+        x = x + self.ffwd(self.ln2(x))  # Computation
+        return x
+
+
+class TiedHead(nn.Module):
+    """ output head sharing the (vocab_size, n_embd) weight of an embedding, applied to its input times scale
+
+    Only the bias is allocated, initialized as nn.Linear's would be.
+    """
+
+    def __init__(self, embedding, scale):
+        super().__init__()
+        self.weight = embedding.weight
+        bound = embedding.embedding_dim**-0.5
+        self.bias = nn.Parameter(torch.empty(embedding.num_embeddings).uniform_(-bound, bound))
+        self.scale = scale
+
+    def forward(self, x):
+        return F.linear(x * self.scale, self.weight, self.bias)
+
+
+class LanguageModel(nn.Module):
+    """ the notebook's language model
+
+    tie_weights=True shares the token embedding matrix with the output head
+    and also multiplies the input of the head by n_embd**-0.5: the embedding
+    rows have norm ~sqrt(n_embd), and without the scale the initial logits are
+    that large too (an initial loss of ~25 instead of ~ln(vocab_size)). A tied
+    model is therefore a different model from an untied one, not the same
+    model with fewer parameters; compare their losses with that in mind.
+    """
+
+    def __init__(self, vocab_size, n_embd=64, n_head=4, n_layer=4, block_size=32, dropout=0.0, attention='heads',
+                 tie_weights=False):
+        super().__init__()
+        self.block_size = block_size
+        self.n_head = n_head
+        self.n_embd = n_embd
+        # each token directly reads off the logits for the next token from a lookup table
+        self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
+        self.position_embedding_table = nn.Embedding(block_size, n_embd)
+        self.blocks = nn.Sequential(*[Block(n_embd, n_head, block_size, dropout, attention) for _ in range(n_layer)])
+        self.ln_f = nn.LayerNorm(n_embd) # final layer norm
+        if tie_weights:
+            # one (vocab_size, n_embd) matrix for the input embedding and the output head,
+            # scaled by n_embd**-0.5 so that the tied head gives O(1) logits
+            self.lm_head = TiedHead(self.token_embedding_table, n_embd**-0.5)
+        else:
+            self.lm_head = nn.Linear(n_embd, vocab_size)
+
+    def forward(self, idx, targets=None):
+        B, T = idx.shape
+
+        # idx and targets are both (B,T) tensor of integers
+        tok_emb = self.token_embedding_table(idx) # (B,T,C)
+        pos_emb = self.position_embedding_table(torch.arange(T, device=idx.device)) # (T,C)
+        x = tok_emb + pos_emb # (B,T,C)
+        x = self.blocks(x) # (B,T,C)
+        x = self.ln_f(x) # (B,T,C)
+        logits = self.lm_head(x) # (B,T,vocab_size)
+
+        if targets is None:
+            loss = None
+        else:
+            B, T, C = logits.shape
+            logits = logits.view(B*T, C)
+            targets = targets.reshape(B*T)
+            loss = F.cross_entropy(logits, targets)
+
+        return logits, loss
+
+    def forward_cached(self, idx, cache):
+        """ logits (B, T, vocab_size) of the tokens idx (B, T) following the tokens in cache, which get idx added """
+        B, T = idx.shape
+        # past block_size tokens (rolling cache) the new token takes the last position
+        pos = torch.arange(cache.length, cache.length + T, device=idx.device).clamp_(max=self.block_size - 1)
+        x = self.token_embedding_table(idx) + self.position_embedding_table(pos)
+        for layer, block in enumerate(self.blocks):
+            x = block(x, cache, layer)
+        cache.advance(T)
+        return self.lm_head(self.ln_f(x))
+
+    def make_cache(self, batch_size):
+        weight = self.lm_head.weight
+        return KVCache(len(self.blocks), batch_size, self.n_head, self.n_embd // self.n_head, self.block_size,
+                       device=weight.device, dtype=weight.dtype)
+
+    @torch.no_grad()
+    def generate_cached(self, idx, max_new_tokens, policy='sliding', window=None, sampler=None, stopper=None):
+        """ generate with a KVCache, into a preallocated (B, T + max_new_tokens) output
+
+        Up to block_size tokens this samples from the same distributions as
+        generate. Past that, policy 'sliding' refills the cache with the last
+        window tokens (default block_size // 2) whenever it is full, so the
+        cost of a refill is spread over block_size - window tokens; 'rolling'
+        overwrites the oldest cached token and never recomputes, but the cached
+        keys keep the positions they had when they were computed. With
+        window=block_size every token refills the cache, the same computation
+        as generate.
+
+        sampler and stopper are an lm_sampling.Sampler, to draw the next
+        tokens instead of the plain multinomial, and an lm_sampling.Stopper,
+        to end sequences early: the output is cut after the step where all are done.
+        """
+        B, T = idx.shape
+        window = self.block_size // 2 if window is None else window
+        if policy not in ('sliding', 'rolling') or not 0 < window <= self.block_size:
+            raise ValueError('policy %s, window %s' % (policy, window))
+        out = torch.empty(B, T + max_new_tokens, dtype=idx.dtype, device=idx.device)
+        out[:, :T] = idx
+        if max_new_tokens == 0:
+            return out
+        cache = self.make_cache(B)
+        logits = self.forward_cached(idx[:, -self.block_size:], cache)
+        for t in range(T, T + max_new_tokens):
+            if sampler is None:
+                probs = F.softmax(logits[:, -1, :], dim=-1) # (B, C)
+                idx_next = torch.multinomial(probs, num_samples=1)
+            else:
+                idx_next = sampler.sample(logits[:, -1, :], out[:, :t])
+            done = False
+            if stopper is not None:
+                idx_next, done = stopper.update(idx_next)
+            out[:, t:t + 1] = idx_next
+            if done:
+                return out[:, :t + 1]
+            if t + 1 == T + max_new_tokens:
+                break
+            if policy == 'sliding' and cache.length == self.block_size:
+                cache.reset()
+                logits = self.forward_cached(out[:, t + 1 - window:t + 1], cache)
+            else:
+                logits = self.forward_cached(out[:, t:t + 1], cache)
+        return out
+
+    def generate(self, idx, max_new_tokens, use_cache=False, **kwargs):
+        # idx is (B, T) array of indices in the current context
+        if use_cache:
+            return self.generate_cached(idx, max_new_tokens, **kwargs)
+        for _ in range(max_new_tokens):
+            # crop idx to the last block_size tokens
+            idx_cond = idx[:, -self.block_size:]
+            # get the predictions
+            logits, loss = self(idx_cond)
+            # focus only on the last time step
+            logits = logits[:, -1, :] # becomes (B, C)
+            # apply softmax to get probabilities
+            probs = F.softmax(logits, dim=-1) # (B, C)
+            # sample from the distribution
+            idx_next = torch.multinomial(probs, num_samples=1) # (B, 1)
+            # append sampled index to the running sequence
+            idx = torch.cat((idx, idx_next), dim=1) # (B, T+1)
+        return idx
+
+
+def _time(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t0 = time.time()
+    for __ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - t0) / repeat
+
+
+def count_allocations(fn, device):
+    """ number and total bytes of the tensor allocations made by one call of fn """
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        before = torch.cuda.memory_stats()
+        fn()
+        torch.cuda.synchronize()
+        after = torch.cuda.memory_stats()
+        return (after['allocation.all.allocated'] - before['allocation.all.allocated'],
+                after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated'])
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    sizes = [e.self_cpu_memory_usage for e in prof.events() if e.self_cpu_memory_usage > 0]
+    return len(sizes), sum(sizes)
+
+
+def peak_memory(fn, device):
+    """ peak of the tensor memory allocated during one call of fn, in bytes above what was allocated before """
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+    # replay the allocations and frees recorded by the profiler, in order
+    from torch.profiler import profile, ProfilerActivity
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    current = peak = 0
+    for e in sorted(prof.events(), key=lambda e: e.time_range.start):
+        current += e.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+
+def fused(args):
+    device = torch.device(args.device)
+    torch.manual_seed(1337)
+    print('%-10s %-6s %6s %5s %-10s %12s %10s %12s' % ('n_embd x', 'module', 'batch', 'T', 'pass', 'tokens/s',
+                                                      'allocs', 'alloc MB'))
+    for config in args.configs.split(','):
+        n_embd, n_head = [int(v) for v in config.split('x')]
+        head_size = n_embd // n_head
+        heads = MultiHeadAttention(n_head, head_size, n_embd, args.block_size).to(device)
+        fused_mha = FusedMultiHeadAttention(n_head, head_size, n_embd, args.block_size).to(device)
+        fused_mha.load_state_dict(fuse_attention_state_dict(heads.state_dict()))
+        x = torch.randn(args.batch_size, args.block_size, n_embd, device=device, requires_grad=True)
+        # same weights, same outputs and gradients
+        out = heads(x)
+        out.sum().backward()
+        grad, x.grad = x.grad, None
+        out_fused = fused_mha(x)
+        out_fused.sum().backward()
+        assert torch.allclose(out, out_fused, atol=1e-5, rtol=1e-4)
+        assert torch.allclose(grad, x.grad, atol=1e-5, rtol=1e-4)
+        for name, module in [('heads', heads), ('fused', fused_mha)]:
+            def forward():
+                with torch.no_grad():
+                    module(x)
+
+            def train_step():
+                module(x).sum().backward()
+            for label, fn in [('forward', forward), ('fwd+bwd', train_step)]:
+                t = _time(fn, args.repeat, device)
+                allocs, nbytes = count_allocations(fn, device)
+                print('%-10s %-6s %6d %5d %-10s %12.0f %10d %12.2f' % (
+                    config, name, args.batch_size, args.block_size, label,
+                    args.batch_size * args.block_size / t, allocs, nbytes / 1e6))
+    print('outputs and gradients of the fused module match')
+
+
+def sdpa(args):
+    device = torch.device(args.device)
+    torch.manual_seed(1337)
+    n_embd, n_head = [int(v) for v in args.config.split('x')]
+    head_size = n_embd // n_head
+    block_sizes = [int(b) for b in args.block_sizes.split(',')]
+    print('%-6s %5s %5s %-8s %10s %12s %14s' % ('module', 'batch', 'T', 'pass', 'time (ms)', 'tokens/s', 'peak mem (MB)'))
+    for T in block_sizes:
+        reference = MultiHeadAttention(n_head, head_size, n_embd, T).to(device)
+        state = fuse_attention_state_dict(reference.state_dict())
+        modules = OrderedDict([('heads', reference)])
+        for name in ['fused', 'sdpa']:
+            modules[name] = ATTENTION[name](n_head, head_size, n_embd, T).to(device)
+            modules[name].load_state_dict(state)
+        x = torch.randn(args.batch_size, T, n_embd, device=device, requires_grad=True)
+        out = None
+        for name, module in modules.items():
+            # the materialized paths keep a few (B, nh, T, T) float tensors alive, a train step more
+            scores = args.batch_size * n_head * T * T * 4
+            if name != 'sdpa' and 4 * scores > args.max_scores_mb * 1e6:
+                print('%-6s %5d %5d %-8s %10s' % (name, args.batch_size, T, '', 'skipped: (B, nh, T, T) scores too large'))
+                continue
+            with torch.no_grad():
+                if out is None:
+                    out = module(x)
+                else:
+                    assert torch.allclose(out, module(x), atol=1e-5, rtol=1e-4), name
+
+            def forward():
+                with torch.no_grad():
+                    module(x)
+
+            def train_step():
+                module(x).sum().backward()
+                x.grad = None
+                module.zero_grad(set_to_none=True)
+            passes = [('forward', forward)] + ([('fwd+bwd', train_step)] if args.backward else [])
+            for label, fn in passes:
+                t = _time(fn, args.repeat, device)
+                peak = peak_memory(fn, device)
+                print('%-6s %5d %5d %-8s %10.2f %12.0f %14.1f' % (name, args.batch_size, T, label, 1e3 * t,
+                                                                 args.batch_size * T / t, peak / 1e6))
+    print('outputs of the three attention implementations match')
+
+
+def generate(args):
+    device = torch.device(args.device)
+    n_embd, n_head = [int(v) for v in args.config.split('x')]
+    torch.manual_seed(1337)
+    model = LanguageModel(65, n_embd, n_head, args.n_layer, args.block_size, attention=args.attention).to(device).eval()
+    idx = torch.zeros(args.batch_size, 1, dtype=torch.long, device=device)
+    # same samples as generate while the context fits, and with window=block_size past it
+    for n, kwargs in [(args.block_size - 1, {}), (2 * args.block_size, {'window': args.block_size})]:
+        torch.manual_seed(0)
+        reference = model.generate(idx, n)
+        torch.manual_seed(0)
+        assert torch.equal(reference, model.generate(idx, n, use_cache=True, **kwargs))
+
+    lengths = [int(n) for n in args.lengths.split(',')]
+    variants = [('generate', {}), ('cached sliding', {'use_cache': True}),
+                ('cached rolling', {'use_cache': True, 'policy': 'rolling'})]
+    print('%-15s %8s %14s %18s' % ('', 'tokens', 'ms/token', 'ms/token since prev'))
+    for name, kwargs in variants:
+        previous = (0, 0.0)
+        for n in lengths:
+            with torch.no_grad():
+                t = _time(lambda: model.generate(idx, n, **kwargs), args.repeat, device)
+            marginal = (t - previous[1]) / (n - previous[0])
+            print('%-15s %8d %14.3f %18.3f' % (name, n, 1e3 * t / n, 1e3 * marginal))
+            previous = (n, t)
+    print('cached generation matches generate')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Language model benchmarks',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+    p = sub.add_parser('fused', help='compare FusedMultiHeadAttention with the per-head MultiHeadAttention',
+                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--configs', default='64x4,128x8,256x16', help='comma separated n_embd x n_head')
+    p.add_argument('--batch-size', default=16, type=int)
+    p.add_argument('--block-size', default=32, type=int)
+    p.add_argument('--repeat', default=50, type=int)
+    p.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    p = sub.add_parser('sdpa', help='compare scaled_dot_product_attention with the materialized causal mask',
+                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--config', default='64x4', help='n_embd x n_head')
+    p.add_argument('--batch-size', default=4, type=int)
+    p.add_argument('--block-sizes', default='32,128,512,1024,2048,4096')
+    p.add_argument('--no-backward', dest='backward', action='store_false', help='time the forward pass only')
+    p.add_argument('--max-scores-mb', default=2048, type=float,
+                   help='skip the materialized paths when their scores would take more memory than this')
+    p.add_argument('--repeat', default=5, type=int)
+    p.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    p = sub.add_parser('generate', help='per token latency of generate with and without the KV cache',
+                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--config', default='64x4', help='n_embd x n_head')
+    p.add_argument('--n-layer', default=4, type=int)
+    p.add_argument('--block-size', default=256, type=int)
+    p.add_argument('--attention', default='sdpa', choices=list(ATTENTION))
+    p.add_argument('--batch-size', default=1, type=int)
+    p.add_argument('--lengths', default='32,128,256,512,1024', help='numbers of tokens to generate')
+    p.add_argument('--repeat', default=1, type=int)
+    p.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args)
+    elif args.command == 'sdpa':
+        sdpa(args)
+    else:
+        if args.command is None:
+            args = parser.parse_args(['fused'])
+        fused(args)
@@ -0,0 +1,236 @@
+# Sampling of the next token for a batch of sequences: repetition penalty,
+# temperature, top-k and top-p (nucleus), and per sequence stopping.
+#
+#   python lm_sampling.py                  # checks against a per sequence loop and timings
+#
+# With the models of this directory (lm_model.LanguageModel, or the
+# LanguageModel class of the notebook):
+#   from lm_sampling import Sampler, generate
+#   out, lengths = generate(model, context, 500, Sampler(temperature=0.8, top_k=20, top_p=0.9),
+#                           stop_tokens=[stoi['\n']], block_size=block_size)
+# With the GPT-2 pipeline of the notebook (top_k=0 turns off the pipeline's own top-k):
+#   generator(input_text, max_new_tokens=20, num_return_sequences=5, do_sample=True, top_k=0,
+#             logits_processor=[Sampler(temperature=0.8, top_p=0.9, repetition_penalty=1.2).logits_processor()])
+from __future__ import print_function
+import time
+import argparse
+
+import torch
+from torch.nn import functional as F
+
+try:
+    from transformers import LogitsProcessor
+except ImportError:
+    LogitsProcessor = object
+
+
+class Sampler(object):
+    """ draws the next token of every sequence of a batch from its logits
+
+    Applied in this order, to all the rows at once: the repetition penalty
+    (logits of the tokens already in the sequence divided by the penalty if
+    positive, multiplied if negative, as in the CTRL paper and HuggingFace),
+    the temperature, then top-k and top-p. When top_p is set, top-k and top-p
+    share one sort and one mask; top-p keeps the smallest set of tokens whose
+    probabilities, renormalized over the top-k, add up to at least top_p.
+    temperature=0 picks the most likely token.
+    """
+
+    def __init__(self, temperature=1.0, top_k=None, top_p=None, repetition_penalty=1.0):
+        if temperature < 0 or (top_p is not None and not 0 < top_p <= 1) or repetition_penalty <= 0:
+            raise ValueError('temperature %s, top_p %s, repetition_penalty %s' % (temperature, top_p,
+                                                                                  repetition_penalty))
+        self.temperature = temperature
+        self.top_k = top_k or None
+        self.top_p = top_p if top_p is not None and top_p < 1 else None
+        self.repetition_penalty = repetition_penalty
+
+    def process(self, logits, idx=None):
+        """ logits (B, V) with -inf where a token can not be drawn; idx (B, T) are the tokens so far """
+        if self.repetition_penalty != 1.0 and idx is not None and idx.shape[1] > 0:
+            seen = logits.gather(1, idx)
+            seen = torch.where(seen < 0, seen * self.repetition_penalty, seen / self.repetition_penalty)
+            logits = logits.scatter(1, idx, seen)
+        if self.temperature not in (0, 1):
+            logits = logits / self.temperature
+        top_k = None if self.top_k is None or self.top_k >= logits.shape[-1] else self.top_k
+        if self.top_p is not None:
+            sorted_logits, order = torch.sort(logits, dim=-1, descending=True)
+            if top_k is not None:
+                sorted_logits[:, top_k:] = float('-inf')
+            probs = F.softmax(sorted_logits, dim=-1)
+            # drop a token when the tokens before it already reach top_p; the most likely one always stays
+            remove = probs.cumsum(dim=-1) - probs >= self.top_p
+            if top_k is not None:
+                remove[:, top_k:] = True
+            logits = logits.masked_fill(remove.scatter(1, order, remove), float('-inf'))
+        elif top_k is not None:
+            kth = torch.topk(logits, top_k, dim=-1).values[:, -1:]
+            logits = logits.masked_fill(logits < kth, float('-inf'))
+        return logits
+
+    def sample(self, logits, idx=None):
+        """ next tokens (B, 1) """
+        logits = self.process(logits, idx)
+        if self.temperature == 0:
+            return logits.argmax(dim=-1, keepdim=True)
+        return torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+
+    def logits_processor(self):
+        """ the same processing as a HuggingFace logits processor, for generate / pipeline(logits_processor=[...]) """
+        return SamplerLogitsProcessor(self)
+
+
+class SamplerLogitsProcessor(LogitsProcessor):
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    def __call__(self, input_ids, scores):
+        return self.sampler.process(scores, input_ids)
+
+
+class Stopper(object):
+    """ per sequence stopping criteria of a batch
+
+    max_new_tokens is one number for all the sequences or one per sequence;
+    stop_tokens is None, a list of token ids for all the sequences or one list
+    per sequence. A sequence is done after its stop token (which is kept) or
+    after its max_new_tokens; its later tokens are pad_token. lengths counts
+    the new tokens of every sequence.
+    """
+
+    def __init__(self, batch_size, max_new_tokens, stop_tokens=None, pad_token=0, device=None):
+        self.max_new_tokens = torch.as_tensor(max_new_tokens, device=device).expand(batch_size).clone()
+        self.max_steps = int(self.max_new_tokens.max()) if batch_size > 0 else 0
+        self.stop_tokens = None
+        if stop_tokens is not None and len(stop_tokens) > 0:
+            if not isinstance(stop_tokens[0], (list, tuple)):
+                stop_tokens = [stop_tokens] * batch_size
+            width = max(len(s) for s in stop_tokens)
+            # (B, S), padded with -1 which matches no token
+            self.stop_tokens = torch.tensor([list(s) + [-1] * (width - len(s)) for s in stop_tokens],
+                                            dtype=torch.long, device=device)
+        self.pad_token = pad_token
+        self.done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        self.lengths = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def update(self, next_tokens):
+        """ next_tokens (B, 1) with pad_token for the sequences that are done; True when all are """
+        next_tokens = next_tokens.masked_fill(self.done[:, None], self.pad_token)
+        self.lengths += ~self.done
+        finished = self.lengths >= self.max_new_tokens
+        if self.stop_tokens is not None:
+            finished |= (next_tokens == self.stop_tokens).any(dim=-1)
+        self.done |= finished
+        return next_tokens, bool(self.done.all())
+
+
+@torch.no_grad()
+def generate(model, idx, max_new_tokens, sampler=None, stop_tokens=None, block_size=None, pad_token=0, **kwargs):
+    """ generate up to max_new_tokens (one number or one per sequence) after the contexts idx (B, T)
+
+    Returns the (B, T + n) tokens, n the most new tokens of any sequence, and
+    the number of new tokens of every sequence; generation stops as soon as
+    all the sequences are done. Models with a KV cache (lm_model.LanguageModel)
+    use it, with kwargs passed to generate_cached; for other models, e.g. the
+    notebook's LanguageModel, whose forward returns (logits, loss), the
+    context is cropped to the last block_size tokens.
+    """
+    stopper = Stopper(idx.shape[0], max_new_tokens, stop_tokens, pad_token, idx.device)
+    sampler = Sampler() if sampler is None else sampler
+    if hasattr(model, 'generate_cached'):
+        out = model.generate_cached(idx, stopper.max_steps, sampler=sampler, stopper=stopper, **kwargs)
+        return out, stopper.lengths
+    B, T = idx.shape
+    block_size = block_size or getattr(model, 'block_size', None) or T + stopper.max_steps
+    out = torch.empty(B, T + stopper.max_steps, dtype=idx.dtype, device=idx.device)
+    out[:, :T] = idx
+    for t in range(T, T + stopper.max_steps):
+        logits, loss = model(out[:, max(0, t - block_size):t])
+        next_tokens, done = stopper.update(sampler.sample(logits[:, -1, :], out[:, :t]))
+        out[:, t:t + 1] = next_tokens
+        if done:
+            return out[:, :t + 1], stopper.lengths
+    return out, stopper.lengths
+
+
+def _reference_process(sampler, logits, idx):
+    """ Sampler.process one sequence at a time with python loops, to check the vectorized version """
+    rows = []
+    for b in range(logits.shape[0]):
+        row = logits[b].clone()
+        if sampler.repetition_penalty != 1.0:
+            for token in set(idx[b].tolist()):
+                row[token] = row[token] * sampler.repetition_penalty if row[token] < 0 else \
+                    row[token] / sampler.repetition_penalty
+        if sampler.temperature not in (0, 1):
+            row = row / sampler.temperature
+        keep = torch.argsort(row, descending=True).tolist()
+        if sampler.top_k is not None:
+            keep = keep[:sampler.top_k]
+        if sampler.top_p is not None:
+            probs = F.softmax(row[keep], dim=-1)
+            total = 0.0
+            for i, p in enumerate(probs.tolist()):
+                total += p
+                if total >= sampler.top_p:
+                    keep = keep[:i + 1]
+                    break
+        mask = torch.ones_like(row, dtype=torch.bool)
+        mask[keep] = False
+        rows.append(row.masked_fill(mask, float('-inf')))
+    return torch.stack(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks and timings of the batched sampler',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--batch-size', default=64, type=int)
+    parser.add_argument('--vocab-sizes', default='65,50257')
+    parser.add_argument('--repeat', default=20, type=int)
+    args = parser.parse_args()
+    torch.manual_seed(1337)
+
+    # the vectorized filters keep the same tokens as a loop over the sequences
+    settings = [dict(temperature=0.7), dict(top_k=5), dict(top_p=0.9), dict(top_k=20, top_p=0.5),
+                dict(temperature=1.3, top_k=10, top_p=0.8, repetition_penalty=1.5)]
+    logits = torch.randn(8, 65) * 3
+    idx = torch.randint(65, (8, 30))
+    for kwargs in settings:
+        sampler = Sampler(**kwargs)
+        got = sampler.process(logits, idx)
+        assert torch.equal(torch.isinf(got), torch.isinf(_reference_process(sampler, logits, idx))), kwargs
+        assert torch.allclose(got[~torch.isinf(got)], _reference_process(sampler, logits, idx)[~torch.isinf(got)])
+        assert torch.isinf(got).sum(dim=-1).max() < 65
+    assert torch.equal(Sampler(temperature=0).sample(logits), logits.argmax(dim=-1, keepdim=True))
+    print('vectorized sampling matches the per sequence reference')
+
+    # per sequence stopping with early exit, on an untrained model of this directory
+    from lm_model import LanguageModel
+    model = LanguageModel(65, block_size=32, attention='sdpa').eval()
+    context = torch.zeros(4, 1, dtype=torch.long)
+    for use_cache in (True, False):
+        torch.manual_seed(0)
+        target = model if use_cache else (lambda x, m=model: m(x))
+        out, lengths = generate(target, context, [5, 50, 100, 200], Sampler(top_k=10), stop_tokens=[[], [1], [1, 2], [3]],
+                                block_size=32)
+        assert out.shape[1] == 1 + int(lengths.max()) and (lengths <= torch.tensor([5, 50, 100, 200])).all()
+        for b in range(4):
+            assert (out[b, 1 + lengths[b]:] == 0).all()
+        print('use_cache=%s: new tokens per sequence %s, stopped after %d steps' % (
+            use_cache, lengths.tolist(), out.shape[1] - 1))
+
+    print('%6s %8s %-60s %12s' % ('batch', 'vocab', 'sampler', 'ms/sample'))
+    for V in [int(v) for v in args.vocab_sizes.split(',')]:
+        logits = torch.randn(args.batch_size, V)
+        idx = torch.randint(V, (args.batch_size, 256))
+        for kwargs in settings:
+            sampler = Sampler(**kwargs)
+            sampler.sample(logits, idx)
+            t0 = time.time()
+            for __ in range(args.repeat):
+                sampler.sample(logits, idx)
+            t = (time.time() - t0) / args.repeat
+            print('%6d %8d %-60s %12.3f' % (args.batch_size, V, ','.join('%s=%s' % kv for kv in sorted(kwargs.items())),
+                                            1e3 * t))
@@ -0,0 +1,124 @@
+# Training loop for the character level language model of 03_languagemodels.ipynb,
+# with bf16 autocast on CPU (or GPU), a fused / foreach AdamW and optional
+# gradient clipping. Runs every model size with every dtype and reports the
+# training throughput and the final losses. fp16 autocast adds a GradScaler.
+#
+#   python lm_train.py                                     # fp32 vs bf16 on three model sizes
+#   python lm_train.py --sizes 384x6x6 --dtypes bf16 --max-iters 5000 --grad-clip 1.0
+#   python lm_train.py --optimizer foreach --threads 8
+#
+# Sizes are n_embd x n_head x n_layer. bf16 autocast runs the matmuls in
+# bfloat16 and keeps the weights, the optimizer state and the loss in fp32; it
+# pays off on CPUs with AVX512-BF16 or AMX (Sapphire Rapids and later).
+from __future__ import print_function
+import time
+import argparse
+from collections import OrderedDict
+
+import torch
+
+from lm_data import BatchSampler, CharCodec
+from lm_eval import Evaluator
+from lm_model import LanguageModel, ATTENTION
+
+DTYPES = OrderedDict([('fp32', None), ('bf16', torch.bfloat16), ('fp16', torch.float16)])
+
+
+def make_optimizer(model, lr, weight_decay=0.01, impl='fused'):
+    """ AdamW with the fused (one kernel for all the parameters) or foreach (batched) implementation
+
+    fused falls back to foreach on the torch versions and devices without it.
+    """
+    kwargs = {'fused': True} if impl == 'fused' else {'foreach': True} if impl == 'foreach' else {}
+    try:
+        return torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay, **kwargs)
+    except (RuntimeError, TypeError) as e:
+        if impl != 'fused':
+            raise
+        print('fused AdamW not available (%s), using foreach' % e)
+        return torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay, foreach=True)
+
+
+def train(model, optimizer, sampler, max_iters, device, dtype=None, grad_clip=None, warmup_iters=5):
+    """ max_iters steps; returns the tokens per second after warmup_iters and the mean loss of the last 50 steps
+
+    With dtype float16 the loss is scaled by a GradScaler, so that small
+    gradients do not underflow in fp16; bf16 has the range of fp32 and needs none.
+    """
+    if max_iters <= warmup_iters:
+        raise ValueError('max_iters (%d) has to be larger than warmup_iters (%d)' % (max_iters, warmup_iters))
+    scaler = torch.amp.GradScaler(device.type, enabled=dtype == torch.float16)
+    model.train()
+    losses = []
+    t0 = time.time()
+    for it in range(max_iters):
+        if it == warmup_iters:
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            t0 = time.time()
+        xb, yb = sampler()
+        with torch.autocast(device.type, dtype=dtype, enabled=dtype is not None):
+            logits, loss = model(xb, yb)
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        if grad_clip is not None:
+            # clip the true gradients, not the scaled ones
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+        scaler.step(optimizer)
+        scaler.update()
+        losses.append(loss.detach())
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    steps = max_iters - warmup_iters
+    tokens_per_s = steps * sampler.batch_size * sampler.block_size / (time.time() - t0)
+    return tokens_per_s, torch.stack(losses[-50:]).float().mean().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fp32 vs bf16 training of the language model',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input', default='dataset/input.txt')
+    parser.add_argument('--sizes', default='64x4x4,256x8x4,512x8x6', help='comma separated n_embd x n_head x n_layer')
+    parser.add_argument('--dtypes', default='fp32,bf16', help='comma separated: ' + ','.join(DTYPES))
+    parser.add_argument('--batch-size', default=16, type=int)
+    parser.add_argument('--block-size', default=128, type=int)
+    parser.add_argument('--max-iters', default=200, type=int)
+    parser.add_argument('--learning-rate', default=1e-3, type=float)
+    parser.add_argument('--optimizer', default='fused', choices=['fused', 'foreach', 'default'],
+                        help='AdamW implementation')
+    parser.add_argument('--grad-clip', default=None, type=float, help='clip the gradient norm to this')
+    parser.add_argument('--attention', default='sdpa', choices=list(ATTENTION))
+    parser.add_argument('--dropout', default=0.0, type=float)
+    parser.add_argument('--tie-weights', action='store_true', help='share the token embedding and the output head')
+    parser.add_argument('--threads', default=None, type=int, help='torch threads (default: torch default)')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    with open(args.input, 'r', encoding='utf-8') as f:
+        text = f.read()
+    codec = CharCodec.from_text(text)
+    data = torch.from_numpy(codec.encode(text))
+    n = int(0.9 * len(data))
+    splits = OrderedDict([('train', data[:n]), ('val', data[n:])])
+
+    print('%-10s %-5s %10s %12s %10s %20s' % ('size', 'dtype', 'params', 'tokens/s', 'train loss', 'val loss'))
+    for size in args.sizes.split(','):
+        n_embd, n_head, n_layer = [int(v) for v in size.split('x')]
+        for name in args.dtypes.split(','):
+            # the same initial weights and batches for every dtype
+            torch.manual_seed(1337)
+            model = LanguageModel(codec.vocab_size, n_embd, n_head, n_layer, args.block_size, args.dropout,
+                                  args.attention, args.tie_weights).to(device)
+            optimizer = make_optimizer(model, args.learning_rate, impl=args.optimizer)
+            # every batch is done with before the next is drawn: reuse the buffers
+            sampler = BatchSampler(splits['train'], args.block_size, args.batch_size, device, out_buffers=True,
+                                   generator=torch.Generator().manual_seed(0))
+            tokens_per_s, loss = train(model, optimizer, sampler, args.max_iters, device, DTYPES[name], args.grad_clip)
+            # evaluated in fp32, so that the dtypes are compared on the same footing
+            val = Evaluator(model, {'val': splits['val']}, args.block_size, device=device)()['val']
+            print('%-10s %-5s %10d %12.0f %10.4f %20s' % (size, name, sum(p.numel() for p in model.parameters()),
+                                                          tokens_per_s, loss, val))
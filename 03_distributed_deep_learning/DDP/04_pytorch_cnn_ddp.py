@@ -3,6 +3,7 @@ import os
 import argparse
 import time
 import socket
+import sys
 
 import numpy
 
@@ -15,6 +16,10 @@ import torch.utils.data.distributed
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 
+# the test set evaluation shared with the Horovod script
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from evaluation import Evaluator
+
 # Set global variables for rank, local_rank, world size
 from mpi4py import MPI
 
@@ -22,8 +27,8 @@ from mpi4py import MPI
 parser = argparse.ArgumentParser(description='PyTorch MNIST Example')
 parser.add_argument('--batch_size', type=int, default=512, metavar='N',
                     help='input batch size for training (default: 512)')
-parser.add_argument('--test-batch-size', type=int, default=64, metavar='N',
-                    help='input batch size for testing (default: 16)')
+parser.add_argument('--test-batch-size', type=int, default=1024, metavar='N',
+                    help='input batch size for testing (default: 1024)')
 parser.add_argument('--epochs', type=int, default=32, metavar='N',
                     help='number of epochs to train (default: 32)')
 parser.add_argument('--lr', type=float, default=0.01, metavar='LR',
@@ -44,7 +49,13 @@ parser.add_argument('--wandb', action='store_true',
                     help='whether to use wandb to log data')                
 parser.add_argument('--project', default="sdl-pytorch-mnist", type=str)
 parser.add_argument('--testing', action='store_true', default=False)
+parser.add_argument('--eval-every', type=int, default=1, metavar='K',
+                    help='evaluate on the test set every K epochs (default: 1)')
+parser.add_argument('--async-eval', action='store_true', default=False,
+                    help='evaluate a snapshot of the weights on a background thread')
 parser.add_argument('--ppn', type=int, default=1)
+parser.add_argument('--hierarchical-allreduce', action='store_true', default=False,
+                    help='reduce gradients inside each node of ppn ranks first, then across nodes')
 args = parser.parse_args()
 
 
@@ -170,6 +181,10 @@ if args.device == 'gpu':
 
 # wrap the model in DDP:
 model = DDP(model)
+if args.hierarchical_allreduce:
+    # DDP: replace the flat allreduce of every gradient bucket
+    from hierarchical import HierarchicalGroups, hierarchical_comm_hook
+    model.register_comm_hook(HierarchicalGroups(args.ppn), hierarchical_comm_hook)
 
 
 # DDP: scale learning rate by the number of GPUs.
@@ -218,56 +233,36 @@ def metric_average(val, name):
     return val
 
 
-def test():
-    model.eval()
-    test_loss = torch.tensor(0.0)
-    test_accuracy = torch.tensor(0.0)
-    if args.device == "gpu":
-        test_loss = test_loss.cuda()
-        test_accuracy = test_accuracy.cuda()
-    n = 0
-    for data, target in test_loader:
-        if args.device == "gpu":        
-            data, target = data.cuda(), target.cuda()
-        output = model(data)
-        # sum up batch loss
-        #test_loss += F.nll_loss(output, target, size_average=False).item()
-        test_loss += F.nll_loss(output, target)#.item()
-        # get the index of the max log-probability
-        pred = output.data.max(1, keepdim=True)[1]
-        test_accuracy += pred.eq(target.data.view_as(pred)).float().sum()
-        n=n+1
-
-    # DDP: use test_sampler to determine the number of examples in
-    # this worker's partition.
-    test_loss /= len(test_sampler)
-    test_accuracy /= len(test_sampler)
-
-    # Horovod: average metric values across workers.
-    test_loss = metric_average(test_loss, 'avg_loss')
-    test_accuracy = metric_average(test_accuracy, 'avg_accuracy')
+# DDP: sum the partial results of every worker.
+def allreduce_sum(tensor, name):
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
 
-    # Horovod: print output only on first rank.
-    if rank == 0:
-        print('Test set: Average loss: {:.4f}, Accuracy: {:.2f}%\n'.format(
-            test_loss, 100. * test_accuracy))
-    return test_loss, test_accuracy
 
+evaluator = Evaluator(model.module, test_loader, allreduce_sum, args.device, rank == 0,
+                      asynchronous=args.async_eval)
 
 epoch_times = []
 for epoch in range(1, args.epochs + 1):
     e_start = time.time()
     training_loss, training_acc = train(epoch)
-    if args.testing==1:
-        test_loss, test_acc = test()
+    result = None
+    if args.testing and (epoch % args.eval_every == 0 or epoch == args.epochs):
+        result = evaluator.submit(epoch)
     e_end = time.time()
     epoch_times.append(e_end - e_start)
     if rank==0:
         print("Epoch - %d time: %s seconds" %(epoch, e_end - e_start))
     if (rank==0 and args.wandb):
-        wandb.log({"time_per_epoch": e_end - e_start, 
-            "train_loss": training_loss, "train_acc": training_acc, 
-            "test_loss": test_loss, "test_acc":test_acc}, step=epoch)
+        metrics = {"time_per_epoch": e_end - e_start,
+            "train_loss": training_loss, "train_acc": training_acc}
+        if result is not None:
+            metrics.update({"test_epoch": result[0], "test_loss": result[1], "test_acc": result[2]})
+        wandb.log(metrics, step=epoch)
+# wait for the last asynchronous evaluation
+result = evaluator.collect()
+if (rank==0 and args.wandb and result is not None):
+    wandb.log({"test_epoch": result[0], "test_loss": result[1], "test_acc": result[2]}, step=args.epochs)
 
 t1 = time.time()
 if rank==0:
@@ -0,0 +1,94 @@
+# Flat versus hierarchical allreduce on the gradients of the MNIST CNN
+# (Net in the PyTorch scripts, MNISTClassifier in the Keras ones: both have the
+# same layers), one allreduce per tensor and fused into a single buffer.
+#
+#   mpiexec -n 16 --ppn 4 python DDP/benchmark_hierarchical.py --ppn 4
+#   torchrun --nproc_per_node 4 DDP/benchmark_hierarchical.py --ppn 2   # 2 "nodes" on one machine
+from __future__ import print_function
+import os
+import sys
+import time
+import socket
+import argparse
+
+import numpy
+import torch
+import torch.distributed as dist
+
+from hierarchical import HierarchicalGroups, hierarchical_allreduce
+# the gradient shapes are built from Net, as in the allreduce microbenchmark
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+from allreduce_benchmark import model_shapes
+
+GRADIENTS = model_shapes('Net')
+
+parser = argparse.ArgumentParser(description='Flat vs hierarchical allreduce',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--ppn', type=int, default=4, help='ranks per node')
+parser.add_argument('--device', default='cpu', choices=['cpu', 'gpu'])
+parser.add_argument('--iterations', type=int, default=50, help='timed iterations per mode')
+parser.add_argument('--warmup', type=int, default=5, help='untimed iterations per mode')
+args = parser.parse_args()
+
+# torchrun sets RANK/WORLD_SIZE/MASTER_ADDR, otherwise take them from MPI
+if 'RANK' not in os.environ:
+    from mpi4py import MPI
+    os.environ['RANK'] = str(MPI.COMM_WORLD.Get_rank())
+    os.environ['WORLD_SIZE'] = str(MPI.COMM_WORLD.Get_size())
+    os.environ['MASTER_ADDR'] = MPI.COMM_WORLD.bcast(socket.gethostname() if MPI.COMM_WORLD.Get_rank() == 0 else None, root=0)
+    os.environ.setdefault('MASTER_PORT', '2345')
+dist.init_process_group(backend='nccl' if args.device == 'gpu' else 'gloo', init_method='env://')
+rank = dist.get_rank()
+size = dist.get_world_size()
+if args.device == 'gpu':
+    torch.cuda.set_device(rank % args.ppn)
+device = torch.device('cuda' if args.device == 'gpu' else 'cpu')
+groups = HierarchicalGroups(args.ppn)
+
+
+def flat(tensor):
+    dist.all_reduce(tensor)
+
+
+def hierarchical(tensor):
+    hierarchical_allreduce(tensor, groups)
+
+
+def run(allreduce, fused):
+    torch.manual_seed(rank)
+    grads = [torch.randn(shape, device=device) for shape in GRADIENTS]
+    expected = [g.clone() for g in grads]
+    for g in expected:
+        dist.all_reduce(g)
+    buffers = [torch.cat([g.flatten() for g in grads])] if fused else grads
+    times = []
+    for i in range(args.warmup + args.iterations):
+        work = [b.clone() for b in buffers]
+        dist.barrier()
+        t0 = time.time()
+        for b in work:
+            allreduce(b)
+        if args.device == 'gpu':
+            torch.cuda.synchronize()
+        if i >= args.warmup:
+            times.append(time.time() - t0)
+    result = torch.split(work[0], [g.numel() for g in grads]) if fused else work
+    ok = all(torch.allclose(r.view(-1), e.view(-1), rtol=1e-4, atol=1e-4) for r, e in zip(result, expected))
+    # the slowest rank defines the time of a collective
+    t = torch.tensor([numpy.mean(times)], dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    return t.item(), ok
+
+
+if __name__ == '__main__':
+    nbytes = sum(int(numpy.prod(shape)) for shape in GRADIENTS) * 4
+    if rank == 0:
+        print('%d ranks, %d per node, %d gradient tensors, %.2f MB' % (size, args.ppn, len(GRADIENTS), nbytes / 1e6))
+        print('%-14s %-11s %12s %14s %8s' % ('allreduce', 'buffers', 'time (ms)', 'algbw (GB/s)', 'correct'))
+    for name, allreduce in [('flat', flat), ('hierarchical', hierarchical)]:
+        for fused in (False, True):
+            t, ok = run(allreduce, fused)
+            if rank == 0:
+                print('%-14s %-11s %12.3f %14.3f %8s' % (name, 'fused' if fused else 'per-tensor',
+                                                         1e3 * t, nbytes / t / 1e9, ok))
+    dist.destroy_process_group()
@@ -0,0 +1,74 @@
+# Hierarchical allreduce for torch.distributed: reduce inside every node to
+# its leader (local rank 0), allreduce among the node leaders, then broadcast
+# inside every node. Only the leaders send data between nodes, which replaces
+# one ring over all ranks by a small ring over the nodes.
+#
+# Works with any backend (gloo on CPU, nccl on GPU). Ranks are assumed to be
+# placed node by node, ppn per node, as done by `mpiexec -n N --ppn ppn` or
+# `aprun -n N -N ppn` (rank // ppn is the node, rank % ppn the local rank).
+import torch
+import torch.distributed as dist
+
+
+class HierarchicalGroups(object):
+    """ Node-local process groups and the group of node leaders """
+
+    def __init__(self, ppn):
+        rank = dist.get_rank()
+        size = dist.get_world_size()
+        self.ppn = ppn
+        self.node = rank // ppn
+        self.local_rank = rank % ppn
+        self.leader = self.node * ppn
+        self.nnodes = (size + ppn - 1) // ppn
+        # new_group is collective: every rank creates every group
+        self.local_group = None
+        for node in range(self.nnodes):
+            ranks = list(range(node * ppn, min((node + 1) * ppn, size)))
+            group = dist.new_group(ranks)
+            if node == self.node:
+                self.local_group = group
+        self.leader_group = dist.new_group([node * ppn for node in range(self.nnodes)])
+        self.size = size
+
+    @property
+    def is_leader(self):
+        return self.local_rank == 0
+
+
+def hierarchical_allreduce(tensor, groups, async_op=False):
+    """ Sum tensor over all ranks in place; returns the Work of the final broadcast if async_op """
+    if groups.ppn > 1:
+        dist.reduce(tensor, dst=groups.leader, group=groups.local_group)
+    if groups.nnodes > 1 and groups.is_leader:
+        dist.all_reduce(tensor, group=groups.leader_group)
+    if groups.ppn > 1:
+        return dist.broadcast(tensor, src=groups.leader, group=groups.local_group, async_op=async_op)
+    if async_op:
+        future = torch.futures.Future()
+        future.set_result(tensor)
+        return _Done(future)
+
+
+class _Done(object):
+    """ Work-like handle of an operation that already completed """
+
+    def __init__(self, future):
+        self.future = future
+
+    def wait(self):
+        return True
+
+    def get_future(self):
+        return self.future
+
+
+def hierarchical_comm_hook(groups, bucket):
+    """ DDP communication hook averaging the gradient bucket hierarchically:
+
+        model.register_comm_hook(HierarchicalGroups(ppn), hierarchical_comm_hook)
+    """
+    tensor = bucket.buffer()
+    tensor.div_(groups.size)
+    work = hierarchical_allreduce(tensor, groups, async_op=True)
+    return work.get_future().then(lambda fut: tensor)
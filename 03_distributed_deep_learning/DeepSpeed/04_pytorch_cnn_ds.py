@@ -3,6 +3,8 @@ import os
 import argparse
 import time
 import socket
+import json
+import resource
 
 import numpy
 import torch
@@ -13,6 +15,13 @@ from torchvision import datasets, transforms
 from mpi4py import MPI
 rank = MPI.COMM_WORLD.rank
 size = MPI.COMM_WORLD.size
+# DeepSpeed picks its accelerator when it is imported, so the device has
+# to be known before the import: DS_ACCELERATOR=cpu selects the CPU
+# accelerator (gloo backend, fp32/bf16).
+pre_parser = argparse.ArgumentParser(add_help=False)
+pre_parser.add_argument('--device', default='gpu', choices=['cpu', 'gpu'])
+if pre_parser.parse_known_args()[0].device == 'cpu':
+    os.environ.setdefault('DS_ACCELERATOR', 'cpu')
 # import module
 import deepspeed
 
@@ -32,13 +41,33 @@ parser.add_argument('--wandb', action='store_true',
                     help='whether to use wandb to log data')                
 parser.add_argument('--project', default="sdl-pytorch-mnist", type=str)
 parser.add_argument('--testing', action='store_true', default=False)
+parser.add_argument('--test-batch-size', type=int, default=1024, metavar='N',
+                    help='input batch size for testing (default: 1024)')
+parser.add_argument('--device', default='gpu', choices=['cpu', 'gpu'],
+                    help='Whether this is running on cpu or gpu')
+parser.add_argument('--depth', type=int, default=0,
+                    help='number of conv blocks of the deeper DeepNet variant (default: 0, the original Net)')
+parser.add_argument('--width', type=int, default=64,
+                    help='channels of the DeepNet conv blocks (default: 64)')
+parser.add_argument('--checkpoint-activations', action='store_true', default=False,
+                    help='recompute the DeepNet blocks in backward with deepspeed.checkpointing')
+parser.add_argument('--profile-steps', default=None, type=str, metavar='START:END',
+                    help='record the DeepSpeed timer breakdown and FLOPs for training steps START..END-1')
+parser.add_argument('--profile-dir', default='ds_profile', type=str,
+                    help='directory for the per-rank and aggregated profile JSON files')
+parser.add_argument('--report', default=None, type=str,
+                    help='write per-rank memory footprint and step time to this JSON file')
+parser.add_argument('--legacy-test-engine', action='store_true', default=False,
+                    help='get the test loader from a second deepspeed.initialize, as the script used to, '
+                         'to compare the startup time and memory')
 
 # parser
 parser = deepspeed.add_config_arguments(parser)
 
 args = parser.parse_args()
 # initialization
-deepspeed.init_distributed()
+# DDP: What backend?  nccl on GPU, gloo on CPU
+deepspeed.init_distributed(dist_backend='nccl' if args.device == 'gpu' else 'gloo')
 t0 = time.time()
 
 try:
@@ -99,7 +128,15 @@ class Net(nn.Module):
         return F.log_softmax(x)
 
 
-model = Net()
+if args.depth > 0:
+    from deep_net import DeepNet
+    checkpoint = None
+    if args.checkpoint_activations:
+        deepspeed.checkpointing.configure(None)
+        checkpoint = deepspeed.checkpointing.checkpoint
+    model = DeepNet(width=args.width, depth=args.depth, checkpoint=checkpoint)
+else:
+    model = Net()
 
 
 #if args.device == 'gpu':
@@ -109,40 +146,217 @@ model = Net()
 #optimizer = optim.SGD(model.parameters(), lr=args.lr,
 #                      momentum=args.momentum)
 #optimizer = optim.Adam(model.parameters(), lr=args.lr)
+# The config is loaded here and handed to initialize() directly, so that
+# it can be adjusted to the device and the profiling options.
+config_path = args.deepspeed_config
+with open(config_path) as f:
+    ds_config = json.load(f)
+args.deepspeed_config = None
+if args.device == 'cpu' and ds_config.get('fp16', {}).get('enabled', False):
+    # The CPU accelerator has no fp16 (ds_config.json is written for GPUs):
+    # run in fp32, or in bf16 when the config enables it.
+    ds_config['fp16']['enabled'] = False
+    if rank == 0:
+        print('fp16 is not supported on cpu, disabled in the config')
+if args.profile_steps is not None:
+    # The engine only creates its timers when wall_clock_breakdown is set.
+    ds_config['wall_clock_breakdown'] = True
+
 parameters = filter(lambda p: p.requires_grad, model.parameters())
 model_engine, optimizer, train_loader, __ = deepspeed.initialize(
-    args=args, model=model, model_parameters=parameters, training_data=train_dataset)
-__, __, test_loader, __ = deepspeed.initialize(
-    args=args, model=model, training_data=test_dataset)
-#model_engine, optimizer, test_loader, __ = deepspeed.initialize(
-#    args=args, model=model, model_parameters=parameters, training_data=test_dataset)
+    args=args, model=model, model_parameters=parameters, training_data=train_dataset,
+    config=ds_config)
+if args.legacy_test_engine:
+    # The old path: a second engine, optimizer state and communication groups
+    # for the same model, only for its data loader.
+    __, __, test_loader, __ = deepspeed.initialize(
+        args=args, model=model, training_data=test_dataset, config=ds_config)
+else:
+    # The test set only needs a plain distributed loader; evaluation runs through
+    # the existing model_engine, so no second engine, optimizer state or
+    # communication groups are created for it.
+    test_sampler = torch.utils.data.distributed.DistributedSampler(
+        test_dataset, num_replicas=size, rank=rank, shuffle=False)
+    kwargs = {'num_workers': args.num_workers, 'pin_memory': True} if args.device == 'gpu' else {}
+    test_loader = torch.utils.data.DataLoader(
+        test_dataset, batch_size=args.test_batch_size, sampler=test_sampler, **kwargs)
 
 
 ntrain = len(train_loader.dataset)
 ntest = len(test_loader.dataset)
-torch.cuda.set_device(model_engine.local_rank)
-torch.cuda.manual_seed(args.seed)
+if args.device == 'gpu':
+    torch.cuda.set_device(model_engine.local_rank)
+    torch.cuda.manual_seed(args.seed)
+device = model_engine.device
 
 fp16 = model_engine.fp16_enabled()
+bf16 = model_engine.bfloat16_enabled()
+zero_stage = model_engine.zero_optimization_stage()
 if rank==0:
     print("Number of samples: ", ntrain, ntest)
-    print(f'fp16={fp16}')
+    print(f'fp16={fp16} bf16={bf16} zero_stage={zero_stage}')
+
+
+# the fp32 copies of the weights of the DeepSpeed optimizer wrappers: ZeRO 1/2,
+# ZeRO 3, FP16_Optimizer (fused and not) and BF16_Optimizer
+MASTER_WEIGHTS = ['single_partition_of_fp32_groups', 'fp32_partitioned_groups_flat',
+                  'fp32_groups_flat', 'fp32_groups', 'fp32_groups_flat_partition']
+
+
+def memory_footprint():
+    """Bytes of parameters, fp32 master weights and optimizer state held by this rank, plus peak memory.
+
+    With ZeRO stage 3 the parameters are partitioned and the local shard
+    lives in ``ds_tensor``; with stage 1/2 the base optimizer only holds
+    state for this rank's partition. The fp32 master weights are the flat
+    copies kept by the DeepSpeed optimizer wrapper: the whole model for
+    fp16/bf16 without ZeRO, this rank's partition with ZeRO 1/2/3 (which
+    also keep them in fp32 training), none for plain fp32.
+    """
+    param_bytes = 0
+    for p in model_engine.module.parameters():
+        local = getattr(p, 'ds_tensor', p)
+        param_bytes += local.numel() * local.element_size()
+    master_bytes = 0
+    for name in MASTER_WEIGHTS:
+        groups = getattr(optimizer, name, None) or []
+        for group in groups:
+            for t in (group if isinstance(group, (list, tuple)) else [group]):
+                if torch.is_tensor(t):
+                    master_bytes += t.numel() * t.element_size()
+        if master_bytes:
+            break
+    base_optimizer = getattr(optimizer, 'optimizer', optimizer)
+    optimizer_bytes = 0
+    for state in base_optimizer.state.values():
+        for v in state.values():
+            if torch.is_tensor(v):
+                optimizer_bytes += v.numel() * v.element_size()
+    if args.device == 'gpu':
+        peak_bytes = torch.cuda.max_memory_allocated()
+    else:
+        # ru_maxrss is in kilobytes on Linux
+        peak_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {'param_bytes': param_bytes, 'master_weight_bytes': master_bytes,
+            'optimizer_state_bytes': optimizer_bytes, 'peak_bytes': peak_bytes}
+
+
+startup_time = time.time() - t0
+startup_memory = memory_footprint()
+if rank==0:
+    print("Startup time: %s seconds, peak memory after startup: %.1f MB" %(
+        startup_time, startup_memory['peak_bytes'] / 1024.0**2))
+
+
+class StepProfiler(object):
+    """DeepSpeed timer breakdown and FLOP counts for the steps in [start, end).
+
+    Forward/backward/gradient reduction/optimizer-step times come from the
+    engine's wall_clock_breakdown timers (milliseconds), FLOPs from
+    DeepSpeed's FlopsProfiler. The profiler only sees the forward pass; the
+    training FLOPs are estimated as three times the forward FLOPs.
+
+    The reduction timer covers what the engine runs after the backward pass:
+    the gradient allreduce without ZeRO (allreduce_ms); with ZeRO 1/2/3 the
+    reduce-scatter to the owners of the partitions is launched from gradient
+    hooks during the backward pass (with overlap_comm, in buckets), so the
+    timer only sees the remaining buckets and the synchronization
+    (reduce_scatter_tail_ms), and the rest is in backward_ms.
+    """
+
+    def __init__(self, engine, window, outdir):
+        from deepspeed.profiling.flops_profiler import FlopsProfiler
+        from deepspeed.runtime.engine import FORWARD_GLOBAL_TIMER, BACKWARD_GLOBAL_TIMER, \
+            BACKWARD_REDUCE_GLOBAL_TIMER, STEP_GLOBAL_TIMER
+        self.engine = engine
+        self.start, self.end = [int(s) for s in window.split(':')]
+        self.outdir = outdir
+        self.flops_profiler = FlopsProfiler(engine.module)
+        self.reduce_key = 'allreduce_ms' if engine.zero_optimization_stage() == 0 else 'reduce_scatter_tail_ms'
+        self.timer_names = {'forward_ms': FORWARD_GLOBAL_TIMER, 'backward_ms': BACKWARD_GLOBAL_TIMER,
+                            self.reduce_key: BACKWARD_REDUCE_GLOBAL_TIMER, 'step_ms': STEP_GLOBAL_TIMER}
+        self.records = []
+
+    def before_step(self, step):
+        if step == self.start:
+            # drop whatever the timers accumulated before the window
+            for name in self.timer_names.values():
+                self.engine.timers(name).elapsed(reset=True)
+            self.flops_profiler.start_profile()
+
+    def after_step(self, step, wall_time):
+        if not self.start <= step < self.end:
+            return
+        record = {'step': step, 'wall_time': wall_time}
+        for key, name in self.timer_names.items():
+            record[key] = self.engine.timers(name).elapsed(reset=True)
+        forward_flops = self.flops_profiler.get_total_flops()
+        self.flops_profiler.reset_profile()
+        record['forward_flops'] = forward_flops
+        record['train_flops'] = 3 * forward_flops
+        record['achieved_flops_per_s'] = 3 * forward_flops / wall_time
+        self.records.append(record)
+        if step == self.end - 1:
+            self.flops_profiler.end_profile()
+
+    def write(self):
+        """Write this rank's records and, on rank 0, the cross-rank aggregate."""
+        if self.records and self.records[-1]['step'] < self.end - 1:
+            # training finished inside the window
+            self.flops_profiler.end_profile()
+        os.makedirs(self.outdir, exist_ok=True)
+        with open(os.path.join(self.outdir, 'rank%d.json' % rank), 'w') as f:
+            json.dump({'rank': rank, 'steps': self.records}, f, indent=2)
+        keys = ['wall_time', 'forward_ms', 'backward_ms', self.reduce_key, 'step_ms', 'achieved_flops_per_s']
+        local = {key: float(numpy.mean([r[key] for r in self.records])) if self.records else None
+                 for key in keys}
+        gathered = [None] * size
+        torch.distributed.all_gather_object(gathered, local)
+        if rank == 0:
+            summary = {'config': config_path, 'world_size': size, 'steps': [self.start, self.end],
+                       'per_rank': gathered, 'aggregate': {}}
+            for key in keys:
+                values = [g[key] for g in gathered if g[key] is not None]
+                if values:
+                    summary['aggregate'][key] = {'mean': float(numpy.mean(values)),
+                                                 'min': float(numpy.min(values)),
+                                                 'max': float(numpy.max(values))}
+            with open(os.path.join(self.outdir, 'summary.json'), 'w') as f:
+                json.dump(summary, f, indent=2)
+            for key, stats in summary['aggregate'].items():
+                print(" %-22s mean %12.4g  min %12.4g  max %12.4g" %(key, stats['mean'], stats['min'], stats['max']))
+
+
+step_profiler = None
+if args.profile_steps is not None:
+    step_profiler = StepProfiler(model_engine, args.profile_steps, args.profile_dir)
+step_times = []
 def train(epoch):
     model.train()
     running_loss = torch.tensor(0.0)
     training_acc = torch.tensor(0.0)
-    running_loss = running_loss.to(model_engine.local_rank)
-    training_acc = training_acc.to(model_engine.local_rank)
+    running_loss = running_loss.to(device)
+    training_acc = training_acc.to(device)
     for batch_idx, (data, target) in enumerate(train_loader):
-        data, target = data.to(model_engine.local_rank), target.to(
-            model_engine.local_rank)            
+        if step_profiler is not None:
+            step_profiler.before_step(len(step_times))
+        s_start = time.time()
+        data, target = data.to(device), target.to(device)
         optimizer.zero_grad()
         if fp16:
             data=data.half()
+        elif bf16:
+            data=data.bfloat16()
         output = model_engine(data)
         loss = F.nll_loss(output, target)
         model_engine.backward(loss)
         model_engine.step()
+        if args.device == 'gpu':
+            torch.cuda.synchronize()
+        step_time = time.time() - s_start
+        if step_profiler is not None:
+            step_profiler.after_step(len(step_times), step_time)
+        step_times.append(step_time)
         pred = output.data.max(1, keepdim=True)[1]
         training_acc += pred.eq(target.data.view_as(pred)).float().sum()
         running_loss += loss
@@ -157,38 +371,39 @@ def train(epoch):
 
 
 def test():
-    model.eval()
-    test_loss = torch.tensor(0.0)
-    test_accuracy = torch.tensor(0.0)
-    test_loss = test_loss.cuda()
-    test_accuracy = test_accuracy.cuda()
-    n = 0
-    test_loss = test_loss.to(model_engine.local_rank)
-    test_accuracy = test_accuracy.to(model_engine.local_rank)
-
-    for data, target in test_loader:
-        data, target = data.to(model_engine.local_rank), target.to(
-            model_engine.local_rank)
-        if fp16:
-            data=data.half()
-        output = model_engine(data)
-        # sum up batch loss
-        #test_loss += F.nll_loss(output, target, size_average=False).item()
-        test_loss += F.nll_loss(output, target)#.item()
-        # get the index of the max log-probability
-        pred = output.data.max(1, keepdim=True)[1]
-        test_accuracy += pred.eq(target.data.view_as(pred)).float().sum()
-        n=n+1
+    """Evaluate model_engine on this rank's partition of the test set.
+
+    Loss is summed in float64 and the correct/seen counts in int64, then
+    reduced across ranks with a single pair of all_reduce calls. no_grad()
+    rather than inference_mode() because ZeRO stage 3 gathers parameters
+    in forward hooks and those buffers are reused outside of the loop.
+    """
+    model_engine.eval()
+    loss_sum = torch.zeros(1, dtype=torch.float64, device=device)
+    counts = torch.zeros(2, dtype=torch.int64, device=device)
+    with torch.no_grad():
+        for data, target in test_loader:
+            data, target = data.to(device), target.to(device)
+            if fp16:
+                data=data.half()
+            elif bf16:
+                data=data.bfloat16()
+            output = model_engine(data)
+            # sum up batch loss
+            loss_sum += F.nll_loss(output.float(), target, reduction='sum').double()
+            # count the predictions matching the target
+            counts[0] += (output.argmax(dim=1) == target).sum()
+            counts[1] += target.numel()
+    model_engine.train()
 
-    # DDP: use test_sampler to determine the number of examples in
-    # this worker's partition.
-    test_loss /= ntest/size
-    test_accuracy /= ntest/size
+    torch.distributed.all_reduce(loss_sum)
+    torch.distributed.all_reduce(counts)
+    test_loss = loss_sum.item() / counts[1].item()
+    test_accuracy = counts[0].item() / counts[1].item()
 
-    # Horovod: print output only on first rank.
     if rank == 0:
         print('Test set: Average loss: {:.4f}, Accuracy: {:.2f}%\n'.format(
-            test_loss, 100. * test_accuracy))
+            test_loss, test_accuracy * 100))
     return test_loss, test_accuracy
 
 
@@ -202,11 +417,37 @@ for epoch in range(1, args.epochs + 1):
     epoch_times.append(e_end - e_start)
     if rank==0: print("Epoch - %d time: %s seconds" %(epoch, e_end - e_start))
     if (args.wandb):
-        wandb.log({"time_per_epoch": e_end - e_start, 
-            "train_loss": training_loss, "train_acc": training_acc, 
-            "test_loss": test_loss, "test_acc":test_acc}, step=epoch)
+        metrics = {"time_per_epoch": e_end - e_start,
+            "train_loss": training_loss, "train_acc": training_acc}
+        if args.testing:
+            metrics.update({"test_loss": test_loss, "test_acc": test_acc})
+        wandb.log(metrics, step=epoch)
 
 t1 = time.time()
 if rank==0:
     print("Total training time: %s seconds" %(t1 - t0))
     print("Average time per epoch in the last 5: ", numpy.mean(epoch_times[-5:]))
+
+if step_profiler is not None:
+    step_profiler.write()
+
+
+if args.report is not None:
+    # skip the first epoch's steps: they include allocation and warmup
+    steady = step_times[len(train_loader):] or step_times
+    local = {'rank': rank, 'device': args.device, 'zero_stage': zero_stage,
+             'legacy_test_engine': args.legacy_test_engine,
+             'fp16': fp16, 'bf16': bf16,
+             'step_time_mean': float(numpy.mean(steady)),
+             'step_time_median': float(numpy.median(steady)),
+             'steps': len(steady),
+             'startup_time': startup_time,
+             'startup_peak_bytes': startup_memory['peak_bytes'],
+             'total_time': t1 - t0}
+    local.update(memory_footprint())
+    reports = [None] * size
+    torch.distributed.all_gather_object(reports, local)
+    if rank==0:
+        with open(args.report, 'w') as f:
+            json.dump({'config': config_path, 'world_size': size,
+                       'ranks': reports}, f, indent=2)
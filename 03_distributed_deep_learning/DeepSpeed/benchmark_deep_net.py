@@ -0,0 +1,222 @@
+# Peak activation memory and throughput of DeepNet for a grid of widths and
+# depths, with and without activation checkpointing, optionally split into
+# a DeepSpeed pipeline. Runs on CPU (gloo, DS_ACCELERATOR=cpu):
+#
+#   mpiexec -n 2 python DeepSpeed/benchmark_deep_net.py --pipeline-stages 2
+#   python DeepSpeed/benchmark_deep_net.py --no-deepspeed    # plain PyTorch, one process
+from __future__ import print_function
+import os
+import time
+import json
+import argparse
+import functools
+import resource
+
+import numpy
+import torch
+import torch.utils.checkpoint
+import torch.nn.functional as F
+
+from deep_net import DeepNet
+
+parser = argparse.ArgumentParser(description='DeepNet activation checkpointing / pipeline benchmark',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--widths', default='32,64,128', help='comma separated block widths')
+parser.add_argument('--depths', default='4,8,16', help='comma separated numbers of blocks')
+parser.add_argument('--batch_size', default=64, type=int, help='micro batch size per rank')
+parser.add_argument('--steps', default=10, type=int, help='timed steps per configuration')
+parser.add_argument('--warmup', default=2, type=int, help='untimed steps per configuration')
+parser.add_argument('--device', default='cpu', choices=['cpu', 'gpu'])
+parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'])
+parser.add_argument('--pipeline-stages', default=1, type=int,
+                    help='split the model into this many PipelineModule stages')
+parser.add_argument('--micro-batches', default=4, type=int,
+                    help='micro batches per step in pipeline mode')
+parser.add_argument('--partition', default='type:ConvBlock',
+                    help='PipelineModule partition_method')
+parser.add_argument('--num_threads', default=0, type=int, help='set number of threads per worker')
+parser.add_argument('--no-deepspeed', action='store_true',
+                    help='plain PyTorch with torch.utils.checkpoint, single process')
+parser.add_argument('--output', default=None, help='write the results as JSON')
+args = parser.parse_args()
+
+if args.device == 'cpu':
+    os.environ.setdefault('DS_ACCELERATOR', 'cpu')
+if args.num_threads != 0:
+    torch.set_num_threads(args.num_threads)
+
+if args.no_deepspeed:
+    if args.pipeline_stages > 1:
+        parser.error('--pipeline-stages needs DeepSpeed')
+    rank, size = 0, 1
+else:
+    import deepspeed
+    from deepspeed.pipe import PipelineModule
+    deepspeed.init_distributed(dist_backend='nccl' if args.device == 'gpu' else 'gloo')
+    rank = torch.distributed.get_rank()
+    size = torch.distributed.get_world_size()
+    deepspeed.checkpointing.configure(None)
+
+
+class ActivationMeter(object):
+    """Live bytes of the tensors autograd keeps for the backward pass.
+
+    Installed through torch.autograd.graph.saved_tensors_hooks: every saved
+    tensor is wrapped in a handle that is released together with the graph,
+    so the peak covers interleaved forward/backward (pipeline schedules) and
+    the recomputation done by activation checkpointing. Storages shared by
+    several saved tensors and the parameters themselves are not counted.
+    """
+
+    def __init__(self, parameters):
+        self.skip = set(p.untyped_storage().data_ptr() for p in parameters)
+        self.refs = {}
+        self.current = 0
+        self.peak = 0
+
+    def pack(self, tensor):
+        return _Saved(self, tensor)
+
+    def unpack(self, saved):
+        return saved.tensor
+
+    def hooks(self):
+        return torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack)
+
+
+class _Saved(object):
+
+    def __init__(self, meter, tensor):
+        self.meter = meter
+        self.tensor = tensor
+        storage = tensor.untyped_storage()
+        self.key = storage.data_ptr()
+        if self.key in meter.skip:
+            self.key = None
+            return
+        if self.key not in meter.refs:
+            meter.refs[self.key] = [0, storage.nbytes()]
+            meter.current += storage.nbytes()
+            meter.peak = max(meter.peak, meter.current)
+        meter.refs[self.key][0] += 1
+
+    def __del__(self):
+        if self.key is None:
+            return
+        ref = self.meter.refs[self.key]
+        ref[0] -= 1
+        if ref[0] == 0:
+            self.meter.current -= ref[1]
+            del self.meter.refs[self.key]
+
+
+def ds_config(micro_batches):
+    return {
+        'train_micro_batch_size_per_gpu': args.batch_size,
+        'gradient_accumulation_steps': micro_batches,
+        'steps_per_print': 1000000,
+        'optimizer': {'type': 'Adam', 'params': {'lr': 0.001}},
+        'bf16': {'enabled': args.precision == 'bf16'},
+    }
+
+
+def synthetic_batches(device, dtype):
+    """ MNIST shaped random micro batches """
+    while True:
+        data = torch.randn(args.batch_size, 1, 28, 28, device=device, dtype=dtype)
+        target = torch.randint(0, 10, (args.batch_size,), device=device)
+        yield data, target
+
+
+def run(width, depth, checkpointing):
+    torch.manual_seed(42)
+    device = torch.device('cuda' if args.device == 'gpu' else 'cpu')
+    dtype = torch.bfloat16 if args.precision == 'bf16' else torch.float32
+
+    if args.no_deepspeed:
+        checkpoint = functools.partial(torch.utils.checkpoint.checkpoint, use_reentrant=True) \
+            if checkpointing else None
+        model = DeepNet(width, depth, checkpoint=checkpoint).to(device=device, dtype=dtype)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+        parameters = list(model.parameters())
+        batches = synthetic_batches(device, dtype)
+
+        def step():
+            data, target = next(batches)
+            optimizer.zero_grad(set_to_none=True)
+            loss = F.nll_loss(model(data).float(), target)
+            loss.backward()
+            optimizer.step()
+        samples_per_step = args.batch_size
+    elif args.pipeline_stages > 1:
+        net = DeepNet(width, depth)
+        model = PipelineModule(layers=net.to_layers(), num_stages=args.pipeline_stages,
+                               loss_fn=lambda output, target: F.nll_loss(output.float(), target),
+                               partition_method=args.partition,
+                               activation_checkpoint_interval=1 if checkpointing else 0)
+        engine, __, __, __ = deepspeed.initialize(model=model, model_parameters=model.parameters(),
+                                                  config=ds_config(args.micro_batches))
+        parameters = list(model.parameters())
+        batches = synthetic_batches(engine.device, dtype)
+
+        def step():
+            engine.train_batch(data_iter=batches)
+        # each replica takes micro_batches * batch_size samples per step,
+        # shared by the pipeline_stages ranks that hold it
+        samples_per_step = args.batch_size * args.micro_batches / float(args.pipeline_stages)
+    else:
+        checkpoint = deepspeed.checkpointing.checkpoint if checkpointing else None
+        model = DeepNet(width, depth, checkpoint=checkpoint)
+        engine, __, __, __ = deepspeed.initialize(model=model, model_parameters=model.parameters(),
+                                                  config=ds_config(1))
+        parameters = list(model.parameters())
+        batches = synthetic_batches(engine.device, dtype)
+
+        def step():
+            data, target = next(batches)
+            loss = F.nll_loss(engine(data).float(), target)
+            engine.backward(loss)
+            engine.step()
+        samples_per_step = args.batch_size
+
+    meter = ActivationMeter(parameters)
+    times = []
+    with meter.hooks():
+        for i in range(args.warmup + args.steps):
+            t0 = time.time()
+            step()
+            if args.device == 'gpu':
+                torch.cuda.synchronize()
+            if i >= args.warmup:
+                times.append(time.time() - t0)
+    return {'width': width, 'depth': depth, 'checkpointing': checkpointing,
+            'pipeline_stages': args.pipeline_stages, 'rank': rank,
+            'params': sum(p.numel() for p in parameters),
+            'peak_activation_bytes': meter.peak,
+            'step_time': float(numpy.mean(times)),
+            'samples_per_second': samples_per_step / float(numpy.mean(times)),
+            # ru_maxrss is in kilobytes on Linux and never decreases
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+if __name__ == '__main__':
+    results = []
+    for width in [int(w) for w in args.widths.split(',')]:
+        for depth in [int(d) for d in args.depths.split(',')]:
+            for checkpointing in (False, True):
+                local = run(width, depth, checkpointing)
+                if size > 1:
+                    gathered = [None] * size
+                    torch.distributed.all_gather_object(gathered, local)
+                else:
+                    gathered = [local]
+                results.extend(gathered)
+                if rank == 0:
+                    # the busiest rank bounds both memory and throughput
+                    peak = max(r['peak_activation_bytes'] for r in gathered)
+                    rate = min(r['samples_per_second'] for r in gathered) * size
+                    print('width %4d depth %3d ckpt %-5s stages %d: peak activations %9.1f MB, %9.1f samples/s' % (
+                        width, depth, checkpointing, args.pipeline_stages, peak / 1024.0**2, rate))
+    if rank == 0 and args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,52 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class ConvBlock(nn.Module):
+    """ 3x3 convolution with a residual connection, keeps the shape of x """
+
+    def __init__(self, width):
+        super(ConvBlock, self).__init__()
+        self.conv = nn.Conv2d(width, width, kernel_size=3, padding=1)
+
+    def forward(self, x):
+        return x + F.relu(self.conv(x))
+
+
+class DeepNet(nn.Module):
+    """ Net with a configurable number (depth) of width-channel conv blocks.
+
+    With checkpoint set (e.g. deepspeed.checkpointing.checkpoint) every
+    block runs through it during training, so only the block inputs are
+    kept for the backward pass and the block is recomputed there.
+    """
+
+    def __init__(self, width=64, depth=4, checkpoint=None):
+        super(DeepNet, self).__init__()
+        self.checkpoint = checkpoint
+        self.conv1 = nn.Conv2d(1, width, kernel_size=3)
+        self.blocks = nn.ModuleList([ConvBlock(width) for _ in range(depth)])
+        self.fc1 = nn.Linear(width * 13 * 13, 128)
+        self.fc2 = nn.Linear(128, 10)
+
+    def forward(self, x):
+        x = F.relu(self.conv1(x))
+        for block in self.blocks:
+            if self.checkpoint is not None and self.training:
+                x = self.checkpoint(block, x)
+            else:
+                x = block(x)
+        x = F.max_pool2d(x, 2)
+        x = F.dropout(x, p=0.25, training=self.training)
+        x = torch.flatten(x, start_dim=1)
+        x = F.relu(self.fc1(x))
+        x = F.dropout(x, p=0.5, training=self.training)
+        x = self.fc2(x)
+        return F.log_softmax(x, dim=1)
+
+    def to_layers(self):
+        """ The same network as a flat list of modules, for deepspeed.pipe.PipelineModule """
+        return [self.conv1, nn.ReLU()] + list(self.blocks) + [
+            nn.MaxPool2d(2), nn.Dropout(0.25), nn.Flatten(),
+            self.fc1, nn.ReLU(), nn.Dropout(0.5), self.fc2, nn.LogSoftmax(dim=1)]
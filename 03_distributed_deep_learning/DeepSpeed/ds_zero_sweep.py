@@ -0,0 +1,105 @@
+# Generate ZeRO stage 1/2/3 (+ CPU offload) variants of ds_config.json, run
+# 04_pytorch_cnn_ds.py with each of them and summarize the per-rank memory
+# footprint and step time.
+#
+#   python DeepSpeed/ds_zero_sweep.py --device cpu --ranks 2 --epochs 2
+#   python DeepSpeed/ds_zero_sweep.py --dry-run      # only write the configs
+from __future__ import print_function
+import os
+import copy
+import json
+import argparse
+import subprocess
+import shlex
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+parser = argparse.ArgumentParser(description='DeepSpeed ZeRO memory/throughput sweep',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--base-config', default=os.path.join(here, 'ds_config.json'),
+                    help='config the variants are derived from')
+parser.add_argument('--outdir', default='ds_zero_sweep', help='where configs and reports are written')
+parser.add_argument('--device', default='cpu', choices=['cpu', 'gpu'])
+parser.add_argument('--precision', default=None, choices=['fp32', 'bf16', 'fp16'],
+                    help='default: fp16 on gpu, fp32 on cpu')
+parser.add_argument('--stages', default='1,2,3', help='comma separated ZeRO stages')
+parser.add_argument('--ranks', default=2, type=int, help='number of ranks per run')
+parser.add_argument('--epochs', default=2, type=int)
+parser.add_argument('--launcher', default='mpiexec -n {ranks}',
+                    help='command prefix used to start the ranks')
+parser.add_argument('--dry-run', action='store_true', help='write the configs without running them')
+args = parser.parse_args()
+
+
+def make_variants(base, stages, precision):
+    """Return {name: config} for every stage with and without offload."""
+    base = copy.deepcopy(base)
+    base['fp16'] = dict(base.get('fp16', {}), enabled=(precision == 'fp16'))
+    base['bf16'] = {'enabled': precision == 'bf16'}
+    zero = base.get('zero_optimization', {})
+    # cpu_offload is the deprecated spelling of offload_optimizer
+    zero.pop('cpu_offload', None)
+    variants = {}
+    for stage in stages:
+        offloads = [(), ('optimizer',)]
+        if stage == 3:
+            offloads.append(('optimizer', 'param'))
+        for offload in offloads:
+            config = copy.deepcopy(base)
+            config['zero_optimization'] = dict(zero, stage=stage)
+            for what in offload:
+                config['zero_optimization']['offload_%s' % what] = {'device': 'cpu', 'pin_memory': args.device == 'gpu'}
+            name = 'zero%d' % stage + ''.join('_offload_%s' % what for what in offload)
+            variants[name] = config
+    return variants
+
+
+def run(name, config_file, report_file):
+    script = os.path.join(here, '04_pytorch_cnn_ds.py')
+    cmd = shlex.split(args.launcher.format(ranks=args.ranks)) + [
+        sys.executable, script, '--deepspeed_config', config_file, '--device', args.device,
+        '--epochs', str(args.epochs), '--report', report_file]
+    print('[%s] %s' % (name, ' '.join(cmd)))
+    with open(os.path.join(args.outdir, name + '.out'), 'w') as log:
+        return subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+
+def summarize(reports):
+    MB = 1024.0 * 1024.0
+    print('%-32s %4s %10s %10s %10s %10s %12s' % ('config', 'rank', 'param MB', 'master MB', 'optim MB',
+                                                  'peak MB', 'step ms'))
+    for name, report in reports:
+        for r in report['ranks']:
+            print('%-32s %4d %10.2f %10.2f %10.2f %10.1f %12.2f' % (
+                name, r['rank'], r['param_bytes'] / MB, r['master_weight_bytes'] / MB,
+                r['optimizer_state_bytes'] / MB, r['peak_bytes'] / MB, r['step_time_mean'] * 1000))
+
+
+if __name__ == '__main__':
+    precision = args.precision or ('fp16' if args.device == 'gpu' else 'fp32')
+    if precision == 'fp16' and args.device == 'cpu':
+        parser.error('fp16 is not supported by the DeepSpeed CPU accelerator, use fp32 or bf16')
+    with open(args.base_config) as f:
+        base = json.load(f)
+    stages = [int(s) for s in args.stages.split(',')]
+    os.makedirs(args.outdir, exist_ok=True)
+
+    reports = []
+    for name, config in make_variants(base, stages, precision).items():
+        config_file = os.path.join(args.outdir, name + '.json')
+        with open(config_file, 'w') as f:
+            json.dump(config, f, indent=2)
+        if args.dry_run:
+            print('wrote', config_file)
+            continue
+        report_file = os.path.join(args.outdir, name + '.report.json')
+        if run(name, config_file, report_file) != 0 or not os.path.exists(report_file):
+            print('[%s] failed, see %s' % (name, os.path.join(args.outdir, name + '.out')))
+            continue
+        with open(report_file) as f:
+            reports.append((name, json.load(f)))
+    if reports:
+        summarize(reports)
+        with open(os.path.join(args.outdir, 'summary.json'), 'w') as f:
+            json.dump(dict(reports), f, indent=2)
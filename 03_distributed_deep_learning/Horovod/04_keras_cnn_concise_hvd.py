@@ -3,13 +3,10 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['MPICH_GPU_SUPPORT_ENABLED']='0'
 import tensorflow as tf
 
-#HVD: (1) Initializing Horovod
-import horovod.tensorflow.keras as hvd
-hvd.init()
-print("I am rank %s of %s" %(hvd.rank(), hvd.size()))
-
 import numpy
 import time
+import queue
+import threading
 import argparse
 parser = argparse.ArgumentParser(description='Horovod',
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -19,8 +16,24 @@ parser.add_argument('--epochs', default=50, type=int, help='Number of epochs to
 parser.add_argument('--warmup_epochs', default=3, type=int, help='Number of epochs to run')
 parser.add_argument('--learning_rate', '--lr', default=0.01, type=float)
 parser.add_argument('--batch_size', default=512, type=int)
+parser.add_argument('--steps_per_execution', default=1, type=int,
+                    help='Number of training steps run per tf.function call')
+parser.add_argument('--checkpoint_dir', default='.', help='Directory for the checkpoints written by rank 0')
+parser.add_argument('--keep_checkpoints', default=3, type=int, help='Number of most recent checkpoints to keep')
+parser.add_argument('--verify_checkpoint', action='store_true',
+                    help='After training, restore the last checkpoint into a new model and compare the weights')
+parser.add_argument('--hierarchical_allreduce', action='store_true',
+                    help='Allreduce inside each node first, then across nodes (HOROVOD_HIERARCHICAL_ALLREDUCE)')
 args = parser.parse_args()
 
+# read by hvd.init()
+if args.hierarchical_allreduce:
+    os.environ['HOROVOD_HIERARCHICAL_ALLREDUCE'] = '1'
+#HVD: (1) Initializing Horovod
+import horovod.tensorflow.keras as hvd
+hvd.init()
+print("I am rank %s of %s" %(hvd.rank(), hvd.size()))
+
 from tensorflow.python.client import device_lib
 
 def get_available_devices():
@@ -42,6 +55,10 @@ tf.config.threading.set_inter_op_parallelism_threads(2)
 # MNIST dataset 
 (x_train, y_train), (x_test, y_test) = tf.keras.datasets.mnist.load_data()
 
+#HVD: (8) keep only the shard of the training set used by this worker
+x_train = x_train[hvd.rank()::hvd.size()]
+y_train = y_train[hvd.rank()::hvd.size()]
+
 x_train = x_train.astype(numpy.float32)
 x_test  = x_test.astype(numpy.float32)
 
@@ -84,48 +101,230 @@ class MNISTClassifier(tf.keras.models.Model):
         return x
 
 
+class WarmupSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+    """ Linear warmup from initial_lr to peak_lr over warmup_steps, then constant.
+
+    Evaluated by the optimizer inside the training graph, so unlike
+    hvd.callbacks.LearningRateWarmupCallback it needs no per batch callback.
+    """
+
+    def __init__(self, initial_lr, peak_lr, warmup_steps):
+        self.initial_lr = initial_lr
+        self.peak_lr = peak_lr
+        self.warmup_steps = warmup_steps
+
+    def __call__(self, step):
+        if self.warmup_steps == 0:
+            return tf.constant(self.peak_lr, tf.float32)
+        progress = tf.cast(step, tf.float32) / float(self.warmup_steps)
+        return self.initial_lr + (self.peak_lr - self.initial_lr) * tf.minimum(progress, 1.0)
+
+    def get_config(self):
+        return {'initial_lr': self.initial_lr, 'peak_lr': self.peak_lr, 'warmup_steps': self.warmup_steps}
+
+
+class LearningRateLogger(tf.keras.callbacks.Callback):
+    """ Add the current learning rate to the epoch logs """
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None:
+            opt = self.model.optimizer
+            logs['lr'] = float(opt.lr(opt.iterations)) if callable(opt.lr) else float(opt.lr)
+
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    """ Wall time of every epoch from skip_epochs on; earlier (warmup) epochs are not timed """
+
+    def __init__(self, skip_epochs=1):
+        tf.keras.callbacks.Callback.__init__(self)
+        self.skip_epochs = skip_epochs
+        self.epoch_times = []
 
-def train_network_concise(_batch_size, _n_training_epochs, _lr):
+    def on_epoch_begin(self, epoch, logs=None):
+        self.t0 = time.time()
 
+    def on_epoch_end(self, epoch, logs=None):
+        if epoch >= self.skip_epochs:
+            self.epoch_times.append(time.time() - self.t0)
+
+    @property
+    def total_time(self):
+        return sum(self.epoch_times)
+
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    """ Save the weights at the end of every epoch without stalling training.
+
+    The weights are copied to host memory (the snapshot) and written by a
+    background thread as checkpoint-<epoch>.npz: written to a temporary file,
+    fsync'ed and renamed, and the directory fsync'ed, so a checkpoint on disk
+    is always complete and survives a crash. Only the keep most recent
+    checkpoints are kept. At most one snapshot waits for the writer, which
+    bounds the host memory used.
+
+    The npz file holds one array per entry of model.weights, under the key
+    '<index>:<weight name>'; AsyncCheckpoint.restore(model, path) loads it
+    back into a built model of the same architecture.
+    """
+
+    def __init__(self, directory='.', keep=3):
+        tf.keras.callbacks.Callback.__init__(self)
+        self.directory = directory
+        self.keep = keep
+        self.saved = []
+        self.records = []
+        self.error = None
+        self.queue = queue.Queue(maxsize=1)
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True
+        self.writer.start()
+        os.makedirs(directory, exist_ok=True)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._check()
+        t0 = time.time()
+        names = [w.name for w in self.model.weights]
+        values = self.model.get_weights()
+        self.queue.put((epoch + 1, names, values, t0, time.time() - t0))
+
+    def on_train_end(self, logs=None):
+        # the last checkpoint is durable when fit returns
+        self.queue.join()
+        self._check()
+
+    @staticmethod
+    def restore(model, path):
+        """ Load the weights of a checkpoint-<epoch>.npz into a built model """
+        with numpy.load(path) as f:
+            # the index prefix keeps the order of model.weights
+            keys = sorted(f.files)
+            values = [f[k] for k in keys]
+        if len(values) != len(model.weights):
+            raise ValueError("%s has %d weights, the model %d" % (path, len(values), len(model.weights)))
+        for key, value, w in zip(keys, values, model.weights):
+            # weight names get a per instance suffix, so only the shapes are compared
+            if tuple(value.shape) != tuple(w.shape):
+                raise ValueError("%s: %s has shape %s, the model's %s has %s"
+                                 % (path, key, value.shape, w.name, tuple(w.shape)))
+        model.set_weights(values)
+
+    def summary(self):
+        if self.records:
+            snapshot = numpy.mean([r['snapshot'] for r in self.records])
+            durable = numpy.mean([r['durable'] for r in self.records])
+            print("Checkpoints: %d written, time to snapshot %.4f s, time to durable %.4f s (mean)"
+                  % (len(self.records), snapshot, durable))
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _write_loop(self):
+        while True:
+            epoch, names, values, t0, snapshot = self.queue.get()
+            try:
+                path = os.path.join(self.directory, 'checkpoint-%d.npz' % epoch)
+                tmp = path + '.tmp'
+                with open(tmp, 'wb') as f:
+                    numpy.savez(f, **{'%04d:%s' % (i, name): v for i, (name, v) in enumerate(zip(names, values))})
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, path)
+                # make the rename durable
+                fd = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                self.records.append({'epoch': epoch, 'snapshot': snapshot, 'durable': time.time() - t0})
+                self.saved.append(path)
+                while len(self.saved) > self.keep:
+                    os.remove(self.saved.pop(0))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+def make_dataset(_batch_size):
+    """ Input pipeline over the local shard: cached, reshuffled every epoch and prefetched """
+    dataset = tf.data.Dataset.from_tensor_slices((numpy.expand_dims(x_train, -1), y_train))
+    dataset = dataset.cache()
+    dataset = dataset.shuffle(len(x_train), reshuffle_each_iteration=True)
+    dataset = dataset.repeat()
+    dataset = dataset.batch(_batch_size, drop_remainder=True)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    # the data is already sharded by worker; do not let tf.distribute shard it again
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return dataset.with_options(options)
+
+
+def build_network_concise(_batch_size, _lr):
+    """ Model, optimizer and callbacks, compiled once and reused by every fit """
     cnn_model = MNISTClassifier()
-    #HVD: (3) scale the learning rate
-    opt = tf.optimizers.Adam(_lr*hvd.size())
+    #HVD: (7) Adjust the number of steps per epochs
+    steps_per_epoch = 60000//hvd.size()//_batch_size
+    #HVD: (3) scale the learning rate, warming up from _lr to _lr*hvd.size() in the graph
+    lr_schedule = WarmupSchedule(_lr, _lr*hvd.size(), args.warmup_epochs*steps_per_epoch)
+    opt = tf.optimizers.Adam(lr_schedule)
     #HVD: (4) add Horovod Distributed Optimizer
     opt = hvd.DistributedOptimizer(opt)
     # Specify `experimental_run_tf_function=False`
     cnn_model.compile(loss="sparse_categorical_crossentropy", optimizer=opt, metrics=['accuracy'],
-                      experimental_run_tf_function=False)
-    #HVD: (5) Define call back
+                      experimental_run_tf_function=False, steps_per_execution=args.steps_per_execution)
+    #HVD: (5) Define call back; none of them does work per batch
     callbacks = [
-        # broad cast 
+        # broad cast (only once, the callback is shared by all the fit calls)
         hvd.callbacks.BroadcastGlobalVariablesCallback(0),
         # Average metric at the end of every epoch
         hvd.callbacks.MetricAverageCallback(),
-        # Warmup 
-        hvd.callbacks.LearningRateWarmupCallback(warmup_epochs=args.warmup_epochs, verbose=1, initial_lr=_lr*hvd.size()),
+        LearningRateLogger(),
     ]
-    #HVD: (6) save checkpoints only on worker 0
+    #HVD: (6) save checkpoints only on worker 0, in the background
     if hvd.rank()==0:
-        callbacks.append(tf.keras.callbacks.ModelCheckpoint('./checkpoint-{epoch}.h5'))
+        callbacks.append(AsyncCheckpoint(args.checkpoint_dir, keep=args.keep_checkpoints))
+    return cnn_model, callbacks, steps_per_epoch
+
+
+def train_network_concise(cnn_model, callbacks, steps_per_epoch, dataset, _n_training_epochs, _initial_epoch=0):
+    """ Train epochs _initial_epoch .. _n_training_epochs-1 of an already compiled model """
+    # one line per epoch on worker 0 instead of a progress bar updated every batch
     verbose=0
     if hvd.rank()==0:
-        verbose=1
-    x_train_reshaped = numpy.expand_dims(x_train, -1)
-    #HVD: (7) Adjust the number of steps per epochs
+        verbose=2
     if (args.device=='cpu'):
         with tf.device('/device:CPU:0'):
-            history = cnn_model.fit(x_train_reshaped, y_train, batch_size=_batch_size, epochs=_n_training_epochs, callbacks=callbacks, steps_per_epoch=60000//hvd.size()//_batch_size, verbose=verbose)
+            history = cnn_model.fit(dataset, epochs=_n_training_epochs, initial_epoch=_initial_epoch, callbacks=callbacks, steps_per_epoch=steps_per_epoch, verbose=verbose)
     else:
-        history = cnn_model.fit(x_train_reshaped, y_train, batch_size=_batch_size, epochs=_n_training_epochs, callbacks=callbacks, steps_per_epoch=60000//hvd.size()//_batch_size, verbose=verbose)
-    return history, cnn_model
+        history = cnn_model.fit(dataset, epochs=_n_training_epochs, initial_epoch=_initial_epoch, callbacks=callbacks, steps_per_epoch=steps_per_epoch, verbose=verbose)
+    return history
 
 batch_size = args.batch_size
 epochs = args.epochs
 lr = args.learning_rate
-history, cnn_model = train_network_concise(batch_size, 1, lr)
+timer = EpochTimer(skip_epochs=1)
+if (args.device=='cpu'):
+    with tf.device('/device:CPU:0'):
+        cnn_model, callbacks, steps_per_epoch = build_network_concise(batch_size, lr)
+else:
+    cnn_model, callbacks, steps_per_epoch = build_network_concise(batch_size, lr)
+callbacks.append(timer)
+dataset = make_dataset(batch_size)
 
-t0 = time.time()
-history, cnn_model = train_network_concise(batch_size, epochs-1, lr)
-t1 = time.time()
+# the first epoch pays for tracing the graph and is not timed; training then
+# continues on the same model, optimizer state and learning rate schedule
+history = train_network_concise(cnn_model, callbacks, steps_per_epoch, dataset, 1)
+history = train_network_concise(cnn_model, callbacks, steps_per_epoch, dataset, epochs, _initial_epoch=1)
 if (hvd.rank()==0):
-    print("Hvd Procs %d Total time: %s second" %(hvd.size(),t1-t0))
+    print("Hvd Procs %d Total time: %s second" %(hvd.size(),timer.total_time))
+    for callback in callbacks:
+        if isinstance(callback, AsyncCheckpoint):
+            callback.summary()
+            if args.verify_checkpoint and callback.saved:
+                restored = MNISTClassifier()
+                restored.build((None, 28, 28, 1))
+                AsyncCheckpoint.restore(restored, callback.saved[-1])
+                if not all(numpy.array_equal(a, b) for a, b in zip(restored.get_weights(), cnn_model.get_weights())):
+                    raise RuntimeError("%s does not restore the trained weights" % callback.saved[-1])
+                print("Checkpoint round trip: %s restores the trained weights" % callback.saved[-1])
@@ -5,6 +5,7 @@ import os
 import argparse
 import time
 import socket
+import sys
 
 import numpy
 import torch
@@ -12,16 +13,17 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torchvision import datasets, transforms
-#HVD: (1) Initialize Horovod
-import horovod.torch as hvd 
-hvd.init()
+
+# the test set evaluation shared with the DDP script
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from evaluation import Evaluator
 
 # Training settings
 parser = argparse.ArgumentParser(description='PyTorch MNIST Example')
 parser.add_argument('--batch_size', type=int, default=512, metavar='N',
                     help='input batch size for training (default: 512)')
-parser.add_argument('--test-batch-size', type=int, default=64, metavar='N',
-                    help='input batch size for testing (default: 16)')
+parser.add_argument('--test-batch-size', type=int, default=1024, metavar='N',
+                    help='input batch size for testing (default: 1024)')
 parser.add_argument('--epochs', type=int, default=32, metavar='N',
                     help='number of epochs to train (default: 32)')
 parser.add_argument('--warmup_epochs', type=int, default=3, metavar='N',
@@ -44,8 +46,21 @@ parser.add_argument('--wandb', action='store_true',
                     help='whether to use wandb to log data')                
 parser.add_argument('--project', default="sdl-pytorch-mnist", type=str)
 parser.add_argument('--testing', action='store_true', default=False)
+parser.add_argument('--eval-every', type=int, default=1, metavar='K',
+                    help='evaluate on the test set every K epochs (default: 1)')
+parser.add_argument('--async-eval', action='store_true', default=False,
+                    help='evaluate a snapshot of the weights on a background thread')
+parser.add_argument('--hierarchical-allreduce', action='store_true', default=False,
+                    help='allreduce inside each node first, then across nodes (HOROVOD_HIERARCHICAL_ALLREDUCE)')
 args = parser.parse_args()
 
+# read by hvd.init()
+if args.hierarchical_allreduce:
+    os.environ['HOROVOD_HIERARCHICAL_ALLREDUCE'] = '1'
+#HVD: (1) Initialize Horovod
+import horovod.torch as hvd 
+hvd.init()
+
 t0 = time.time()
 
 try:
@@ -181,53 +196,35 @@ def train(epoch):
     return running_loss, training_acc
 
 
-def test():
-    model.eval()
-    test_loss = torch.tensor(0.0)
-    test_accuracy = torch.tensor(0.0)
-    if args.device == "gpu":
-        test_loss = test_loss.cuda()
-        test_accuracy = test_accuracy.cuda()
-    n = 0
-    for data, target in test_loader:
-        if args.device == "gpu":        
-            data, target = data.cuda(), target.cuda()
-        output = model(data)
-        # sum up batch loss
-        #test_loss += F.nll_loss(output, target, size_average=False).item()
-        test_loss += F.nll_loss(output, target)#.item()
-        # get the index of the max log-probability
-        pred = output.data.max(1, keepdim=True)[1]
-        test_accuracy += pred.eq(target.data.view_as(pred)).float().sum()
-        n=n+1
-
-    # HVD: use test_sampler to determine the number of examples in
-    # this worker's partition.
-    test_loss /= len(test_sampler)
-    test_accuracy /= len(test_sampler)
-    test_loss = metric_average(test_loss, 'avg_loss')
-    test_accuracy = metric_average(test_accuracy, 'avg_accuracy')
-    # Horovod: print output only on first rank.
-    if hvd.rank() == 0:
-        print('Test set: Average loss: {:.4f}, Accuracy: {:.2f}%\n'.format(
-            test_loss, 100. * test_accuracy))
-    return test_loss, test_accuracy
+# HVD: sum the partial results of every worker.
+def allreduce_sum(tensor, name):
+    return hvd.allreduce(tensor, name=name, op=hvd.Sum)
+
 
+evaluator = Evaluator(model, test_loader, allreduce_sum, args.device, hvd.rank() == 0,
+                      asynchronous=args.async_eval)
 
 epoch_times = []
 for epoch in range(1, args.epochs + 1):
     e_start = time.time()
     training_loss, training_acc = train(epoch)
-    if args.testing==1:
-        test_loss, test_acc = test()
+    result = None
+    if args.testing and (epoch % args.eval_every == 0 or epoch == args.epochs):
+        result = evaluator.submit(epoch)
     e_end = time.time()
     epoch_times.append(e_end - e_start)
     if (hvd.rank()==0):
         print("Epoch - %d time: %s seconds" %(epoch, e_end - e_start))
     if (args.wandb and hvd.rank()==0):
-        wandb.log({"time_per_epoch": e_end - e_start, 
-            "train_loss": training_loss, "train_acc": training_acc, 
-            "test_loss": test_loss, "test_acc":test_acc}, step=epoch)
+        metrics = {"time_per_epoch": e_end - e_start,
+            "train_loss": training_loss, "train_acc": training_acc}
+        if result is not None:
+            metrics.update({"test_epoch": result[0], "test_loss": result[1], "test_acc": result[2]})
+        wandb.log(metrics, step=epoch)
+# wait for the last asynchronous evaluation
+result = evaluator.collect()
+if (hvd.rank()==0 and args.wandb and result is not None):
+    wandb.log({"test_epoch": result[0], "test_loss": result[1], "test_acc": result[2]}, step=args.epochs)
 
 t1 = time.time()
 if (hvd.rank()==0):
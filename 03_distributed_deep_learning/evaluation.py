@@ -0,0 +1,109 @@
+# Test set evaluation shared by DDP/04_pytorch_cnn_ddp.py and
+# Horovod/04_pytorch_cnn_hvd.py. The scripts differ only in how the partial
+# results of the ranks are summed, which they pass in:
+#
+#   # DDP
+#   def allreduce_sum(tensor, name):
+#       dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+#       return tensor
+#   # HVD
+#   def allreduce_sum(tensor, name):
+#       return hvd.allreduce(tensor, name=name, op=hvd.Sum)
+#
+#   evaluator = Evaluator(model, test_loader, allreduce_sum, args.device, rank == 0, args.async_eval)
+#   result = evaluator.submit(epoch)   # (epoch, loss, accuracy) or None
+from __future__ import print_function
+import copy
+import threading
+
+import torch
+import torch.nn.functional as F
+
+
+class Evaluator(object):
+    """Evaluate the model on this rank's partition of the test set.
+
+    The loop runs under torch.inference_mode(), accumulates the summed loss
+    in float64 and the correct/seen counts in int64, and communicates once
+    per evaluation instead of once per metric per batch. With
+    asynchronous=True the weights are copied into a separate replica and
+    evaluated on a background thread while training continues; the result
+    is reduced across ranks the next time submit() or collect() is called.
+    allreduce_sum(tensor, name) returns the sum of tensor over the ranks.
+    """
+
+    def __init__(self, model, loader, allreduce_sum, device='cpu', verbose=True, asynchronous=False):
+        self.model = model
+        self.loader = loader
+        self.allreduce_sum = allreduce_sum
+        self.device = device
+        self.verbose = verbose
+        self.asynchronous = asynchronous
+        self.replica = copy.deepcopy(model) if asynchronous else model
+        self.stream = torch.cuda.Stream() if (asynchronous and device == 'gpu') else None
+        self.thread = None
+        self.pending = None
+
+    def _evaluate(self, model, epoch):
+        model.eval()
+        loss_sum = torch.zeros(1, dtype=torch.float64)
+        counts = torch.zeros(2, dtype=torch.int64)
+        if self.device == "gpu":
+            loss_sum, counts = loss_sum.cuda(), counts.cuda()
+        with torch.inference_mode():
+            for data, target in self.loader:
+                if self.device == "gpu":
+                    data, target = data.cuda(non_blocking=True), target.cuda(non_blocking=True)
+                output = model(data)
+                # sum up batch loss
+                loss_sum += F.nll_loss(output, target, reduction='sum').double()
+                # count the predictions matching the target
+                counts[0] += (output.argmax(dim=1) == target).sum()
+                counts[1] += target.numel()
+        self.pending = (epoch, loss_sum, counts)
+
+    def _evaluate_replica(self, epoch):
+        if self.stream is None:
+            self._evaluate(self.replica, epoch)
+            return
+        with torch.cuda.stream(self.stream):
+            self._evaluate(self.replica, epoch)
+        self.stream.synchronize()
+
+    def submit(self, epoch):
+        """Start evaluating the current weights.
+
+        Returns the most recent finished evaluation, (epoch, loss, accuracy),
+        or None if nothing has finished yet. Every rank has to call this at
+        the same epochs since it ends in a collective.
+        """
+        if not self.asynchronous:
+            self._evaluate(self.model, epoch)
+            return self.collect()
+        result = self.collect()
+        # snapshot the current weights into the replica
+        self.replica.load_state_dict(self.model.state_dict())
+        if self.stream is not None:
+            self.stream.wait_stream(torch.cuda.current_stream())
+        self.thread = threading.Thread(target=self._evaluate_replica, args=(epoch,), daemon=True)
+        self.thread.start()
+        return result
+
+    def collect(self):
+        """Wait for an outstanding evaluation and average it across ranks."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.pending is None:
+            return None
+        epoch, loss_sum, counts = self.pending
+        self.pending = None
+        # sum the partial results of every worker
+        loss_sum = self.allreduce_sum(loss_sum, 'test_loss_sum')
+        counts = self.allreduce_sum(counts, 'test_counts')
+        test_loss = loss_sum.item() / counts[1].item()
+        test_accuracy = counts[0].item() / counts[1].item()
+        if self.verbose:
+            print('Test set (epoch {}): Average loss: {:.4f}, Accuracy: {:.2f}%\n'.format(
+                epoch, test_loss, 100. * test_accuracy))
+        return epoch, test_loss, test_accuracy
@@ -14,8 +14,12 @@ GPUS_PER_NODE=4
 RANKS=$((NODES * GPUS_PER_NODE))
 echo NODES=$NODES  PPN=$GPUS_PER_NODE  RANKS=$RANKS
 
-aprun -n 1 -N 1 python Horovod/04_keras_cnn_concise_hvd.py 
-aprun -n 2 -N 2 python Horovod/04_keras_cnn_concise_hvd.py 
-aprun -n 4 -N 4 python Horovod/04_keras_cnn_concise_hvd.py 
-aprun -n 8 -N 4 python Horovod/04_keras_cnn_concise_hvd.py 
-aprun -n 16 -N 4 python Horovod/04_keras_cnn_concise_hvd.py 
+# results/sweep_<job id>/concise_<ranks>.out for 1, 2, 4, ... ranks, then the
+# scaling table (results/concise_*.out are the reference logs, kept as they are)
+OUTDIR=results/sweep_$PBS_JOBID
+RANK_LIST=1
+r=2
+while [ $r -le $RANKS ]; do RANK_LIST=$RANK_LIST,$r; r=$((r * 2)); done
+python tools/launch_sweep.py Horovod/04_keras_cnn_concise_hvd.py --launcher aprun \
+    --ranks $RANK_LIST --ppn $GPUS_PER_NODE --name concise --outdir $OUTDIR
+python tools/scaling_report.py $OUTDIR/concise_*.out --csv $OUTDIR/scaling.csv --plot $OUTDIR/scaling.png
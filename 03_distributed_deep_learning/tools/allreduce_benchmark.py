@@ -0,0 +1,287 @@
+# Allreduce microbenchmark over the gradient tensors of the MNIST CNNs, to
+# separate the cost of the collectives from the compute in the epoch times.
+#
+# Backends: torch.distributed (gloo, or nccl with --device gpu), Horovod and
+# mpi4py, each used if it can be imported. Variants: one allreduce per tensor,
+# tensors packed into buckets of a given size (as DDP does), everything fused
+# into one buffer; fp32 and fp16. Reported per message: latency, algorithm
+# bandwidth (bytes / time) and bus bandwidth (algbw * 2 (n-1) / n, the data
+# every rank sends and receives in a ring allreduce).
+#
+#   python tools/allreduce_benchmark.py --nprocs 4                  # torch only, one box
+#   torchrun --nproc_per_node 4 tools/allreduce_benchmark.py
+#   mpiexec -n 8 python tools/allreduce_benchmark.py --backends torch,horovod,mpi4py --json ar.json
+from __future__ import print_function
+import os
+import ast
+import time
+import json
+import socket
+import argparse
+from collections import OrderedDict
+
+import numpy
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# the training script defining each model; Net is the same in the Horovod and
+# DeepSpeed PyTorch scripts, MNISTClassifier in all the Keras ones
+MODELS = OrderedDict([
+    ('Net', 'DDP/04_pytorch_cnn_ddp.py'),
+    ('MNISTClassifier', 'Horovod/04_keras_cnn_concise_hvd.py'),
+])
+DTYPES = {'fp32': (torch.float32, numpy.float32), 'fp16': (torch.float16, numpy.float16)}
+
+
+def load_class(script, name, namespace):
+    """The class name defined in script, without running the rest of the script.
+
+    Only the class statement is executed, in namespace, which has to provide
+    the modules it uses (e.g. nn and F).
+    """
+    with open(script) as f:
+        tree = ast.parse(f.read(), script)
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == name:
+            exec(compile(ast.Module(body=[node], type_ignores=[]), script, 'exec'), namespace)
+            return namespace[name]
+    raise ValueError('%s does not define %s' % (script, name))
+
+
+def model_shapes(model):
+    """Parameter shapes of the model, in the order the parameters are created.
+
+    The model is built from the class of its training script: Net from
+    [p.shape for p in Net().parameters()], MNISTClassifier from its
+    trainable_weights (kernels are HWIO / (in, out)), which needs tensorflow.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', MODELS[model])
+    if model == 'Net':
+        Net = load_class(script, 'Net', {'torch': torch, 'nn': torch.nn, 'F': torch.nn.functional})
+        return [tuple(p.shape) for p in Net().parameters()]
+    import tensorflow as tf
+    MNISTClassifier = load_class(script, 'MNISTClassifier', {'tf': tf})
+    cnn_model = MNISTClassifier()
+    cnn_model.build((None, 28, 28, 1))
+    return [tuple(w.shape) for w in cnn_model.trainable_weights]
+
+
+def buckets(shapes, bucket_bytes, itemsize):
+    """Group the tensors, last created first (the order gradients become ready),
+    into buckets of at most bucket_bytes; 0 means one tensor per bucket and
+    None a single bucket. Returns the number of elements of every bucket."""
+    sizes = [int(numpy.prod(s)) for s in reversed(shapes)]
+    if bucket_bytes is None:
+        return [sum(sizes)]
+    result = []
+    for n in sizes:
+        if result and bucket_bytes > 0 and (result[-1] + n) * itemsize <= bucket_bytes:
+            result[-1] += n
+        else:
+            result.append(n)
+    return result
+
+
+class TorchBackend(object):
+    name = 'torch'
+
+    def __init__(self, device):
+        self.device = torch.device('cuda' if device == 'gpu' else 'cpu')
+        self.size = dist.get_world_size()
+
+    def buffer(self, n, dtype):
+        return torch.ones(n, dtype=DTYPES[dtype][0], device=self.device)
+
+    def allreduce(self, buf):
+        dist.all_reduce(buf)
+
+    def barrier(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize()
+        dist.barrier()
+
+
+class HorovodBackend(object):
+    name = 'horovod'
+
+    def __init__(self, device):
+        import horovod.torch as hvd
+        hvd.init()
+        self.hvd = hvd
+        self.device = torch.device('cuda' if device == 'gpu' else 'cpu')
+        self.size = hvd.size()
+        self.count = 0
+
+    def buffer(self, n, dtype):
+        return torch.ones(n, dtype=DTYPES[dtype][0], device=self.device)
+
+    def allreduce(self, buf):
+        # unique names: horovod matches tensors across ranks by name
+        self.count += 1
+        self.hvd.allreduce_(buf, op=self.hvd.Sum, name='bench.%d' % self.count)
+
+    def barrier(self):
+        self.hvd.allreduce(torch.zeros(1), name='bench.barrier.%d' % self.count)
+
+
+class MPIBackend(object):
+    name = 'mpi4py'
+
+    def __init__(self, device):
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.comm = MPI.COMM_WORLD
+        self.size = self.comm.Get_size()
+
+    def buffer(self, n, dtype):
+        if dtype == 'fp16':
+            # MPI has no half precision type to sum
+            return None
+        return numpy.ones(n, dtype=DTYPES[dtype][1])
+
+    def allreduce(self, buf):
+        self.comm.Allreduce(self.MPI.IN_PLACE, buf, op=self.MPI.SUM)
+
+    def barrier(self):
+        self.comm.Barrier()
+
+
+BACKENDS = OrderedDict([('torch', TorchBackend), ('horovod', HorovodBackend), ('mpi4py', MPIBackend)])
+
+
+def time_message(backend, buf, iterations, warmup):
+    """Mean time of one allreduce of buf, the slowest rank counts."""
+    for __ in range(warmup):
+        backend.allreduce(buf)
+    backend.barrier()
+    t0 = time.time()
+    for __ in range(iterations):
+        backend.allreduce(buf)
+    backend.barrier()
+    return (time.time() - t0) / iterations
+
+
+def run(backend, args, models):
+    """Time every (model, dtype, bucketing) variant; models maps the model names to their shapes.
+
+    Returns the records of every message size and of every step (all the
+    messages of one set of gradients).
+    """
+    messages, steps = [], []
+    n = backend.size
+    for model, shapes in models.items():
+        for dtype in args.dtypes.split(','):
+            itemsize = numpy.dtype(DTYPES[dtype][1]).itemsize
+            if backend.buffer(1, dtype) is None:
+                continue
+            for bucket in args.bucket_sizes.split(','):
+                if bucket == 'fused':
+                    bucket_bytes, label = None, 'fused'
+                elif float(bucket) == 0:
+                    bucket_bytes, label = 0, 'per-tensor'
+                else:
+                    bucket_bytes, label = int(float(bucket) * 1024**2), '%sMB' % bucket
+                sizes = buckets(shapes, bucket_bytes, itemsize)
+                key = OrderedDict([('backend', backend.name), ('ranks', n), ('model', model),
+                                   ('dtype', dtype), ('bucketing', label)])
+                step = 0.0
+                for count in sorted(set(sizes)):
+                    t = time_message(backend, backend.buffer(count, dtype), args.iterations, args.warmup)
+                    step += t * sizes.count(count)
+                    algbw = count * itemsize / t / 1e9
+                    messages.append(OrderedDict(key, bytes=count * itemsize, latency_us=1e6 * t, algbw_GBs=algbw,
+                                                busbw_GBs=algbw * 2.0 * (n - 1) / n))
+                nbytes = sum(sizes) * itemsize
+                steps.append(OrderedDict(key, bytes=nbytes, messages=len(sizes), time_us=1e6 * step,
+                                         algbw_GBs=nbytes / step / 1e9))
+    return messages, steps
+
+
+def print_records(messages, steps):
+    columns = '%-8s %5s %-16s %-5s %-11s'
+    print('Per message size:')
+    print((columns + ' %12s %12s %10s %10s') % ('backend', 'ranks', 'model', 'dtype', 'bucketing',
+                                              'bytes', 'latency(us)', 'algbw', 'busbw'))
+    for r in messages:
+        print((columns + ' %12d %12.1f %10.3f %10.3f') % tuple(list(r.values())[:5] + [
+            r['bytes'], r['latency_us'], r['algbw_GBs'], r['busbw_GBs']]))
+    print('\nAll gradients of one step:')
+    print((columns + ' %12s %8s %12s %10s') % ('backend', 'ranks', 'model', 'dtype', 'bucketing',
+                                             'bytes', 'messages', 'time(us)', 'algbw'))
+    for r in steps:
+        print((columns + ' %12d %8d %12.1f %10.3f') % tuple(list(r.values())[:5] + [
+            r['bytes'], r['messages'], r['time_us'], r['algbw_GBs']]))
+    print('(bandwidths in GB/s)')
+
+
+def main(rank, size, args):
+    if args.nprocs > 0:
+        os.environ.update(RANK=str(rank), WORLD_SIZE=str(size), MASTER_ADDR='127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', '29511')
+    elif 'RANK' not in os.environ:
+        # launched by mpiexec: torch.distributed takes rank and size from MPI
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        os.environ.update(RANK=str(comm.Get_rank()), WORLD_SIZE=str(comm.Get_size()),
+                          MASTER_ADDR=comm.bcast(socket.gethostname() if comm.Get_rank() == 0 else None, root=0))
+        os.environ.setdefault('MASTER_PORT', '2345')
+    dist.init_process_group(backend='nccl' if args.device == 'gpu' else 'gloo', init_method='env://')
+    rank = dist.get_rank()
+    if args.device == 'gpu':
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    torch.set_num_threads(args.num_threads)
+
+    models = OrderedDict()
+    for model in args.models.split(','):
+        try:
+            models[model] = model_shapes(model)
+        except ImportError as e:
+            if rank == 0:
+                print('skipping %s: %s' % (model, e))
+
+    messages, steps = [], []
+    for name in args.backends.split(','):
+        try:
+            backend = BACKENDS[name](args.device)
+        except ImportError as e:
+            if rank == 0:
+                print('skipping %s: %s' % (name, e))
+            continue
+        if backend.size != dist.get_world_size():
+            if rank == 0:
+                print('skipping %s: %d ranks instead of %d (launch with mpiexec)' % (
+                    name, backend.size, dist.get_world_size()))
+            continue
+        m, s = run(backend, args, models)
+        messages.extend(m)
+        steps.extend(s)
+    if rank == 0:
+        print_records(messages, steps)
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump({'messages': messages, 'steps': steps}, f, indent=2)
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Allreduce microbenchmark on the CNN gradient shapes',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--backends', default='torch,horovod,mpi4py', help='comma separated: ' + ','.join(BACKENDS))
+    parser.add_argument('--models', default=','.join(MODELS), help='comma separated: ' + ','.join(MODELS))
+    parser.add_argument('--dtypes', default='fp32,fp16', help='comma separated: fp32,fp16')
+    parser.add_argument('--bucket-sizes', default='0,1,25,fused',
+                        help='comma separated bucket sizes in MB; 0 is one allreduce per tensor, fused a single one')
+    parser.add_argument('--iterations', type=int, default=20, help='timed allreduces per message')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed allreduces per message')
+    parser.add_argument('--device', default='cpu', choices=['cpu', 'gpu'])
+    parser.add_argument('--num_threads', default=1, type=int, help='set number of threads per worker')
+    parser.add_argument('--nprocs', type=int, default=0,
+                        help='spawn this many local processes instead of using a launcher (torch backend only)')
+    parser.add_argument('--json', default=None, help='write the records to this file')
+    args = parser.parse_args()
+
+    if args.nprocs > 0:
+        mp.spawn(main, args=(args.nprocs, args), nprocs=args.nprocs)
+    else:
+        main(None, None, args)
@@ -0,0 +1,149 @@
+# Run a strong scaling sweep of one training script and report it:
+# one run per rank count, launched with mpiexec, aprun or as local processes,
+# the output of each run saved as <outdir>/<name>_<ranks>.out, a results.json
+# with the command, exit status, wall time and the numbers parsed by
+# scaling_report.py, and the scaling table at the end.
+#
+#   python tools/launch_sweep.py Horovod/04_keras_cnn_concise_hvd.py --ranks 1,2,4,8,16 --ppn 4 --launcher aprun
+#   python tools/launch_sweep.py --spec sweep.json --dry-run
+#   python tools/launch_sweep.py tools/allreduce_benchmark.py --ranks 1,2,4 --launcher local -- --models Net
+#
+# A spec file holds the same settings as the command line, e.g.
+#   {"script": "Horovod/04_keras_cnn_concise_hvd.py", "args": ["--device", "cpu"],
+#    "ranks": [1, 2, 4, 8], "ppn": 4, "threads": 8, "bind": "depth", "launcher": "mpiexec"}
+# Local runs start the processes directly with the torch.distributed env://
+# variables (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT) set.
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import subprocess
+from collections import OrderedDict
+
+import scaling_report
+
+DEFAULTS = OrderedDict([
+    ('script', None), ('args', []), ('ranks', [1, 2, 4, 8]), ('ppn', 4), ('threads', None),
+    ('bind', 'depth'), ('launcher', 'mpiexec'), ('python', sys.executable), ('name', None),
+    ('outdir', 'sweep'), ('port', 29500),
+])
+
+
+def command(spec, ranks):
+    """Command line of one run; for the local launcher, the command of one process.
+
+    Without threads the launcher's own depth, binding and OMP_NUM_THREADS
+    apply, as in the hand-written launch lines of the submission scripts.
+    """
+    program = [spec['python'], spec['script']] + list(spec['args'])
+    ppn = min(spec['ppn'], ranks)
+    threads = None if spec['threads'] is None else str(spec['threads'])
+    if spec['launcher'] == 'mpiexec':
+        placement = [] if threads is None else ['--depth', threads, '--cpu-bind', spec['bind'],
+                                                '--env', 'OMP_NUM_THREADS=' + threads]
+        return ['mpiexec', '-n', str(ranks), '--ppn', str(ppn)] + placement + program
+    if spec['launcher'] == 'aprun':
+        placement = [] if threads is None else ['-d', threads, '-cc', spec['bind'], '-e', 'OMP_NUM_THREADS=' + threads]
+        return ['aprun', '-n', str(ranks), '-N', str(ppn)] + placement + program
+    if spec['launcher'] == 'local':
+        return program
+    raise ValueError('unknown launcher %s' % spec['launcher'])
+
+
+def run(spec, ranks, out):
+    """Run with ranks processes, stdout and stderr to out; returns the exit status."""
+    cmd = command(spec, ranks)
+    if spec['launcher'] != 'local':
+        return subprocess.call(cmd, stdout=out, stderr=subprocess.STDOUT)
+    processes = []
+    for rank in range(ranks):
+        env = dict(os.environ, RANK=str(rank), WORLD_SIZE=str(ranks), LOCAL_RANK=str(rank),
+                   MASTER_ADDR='127.0.0.1', MASTER_PORT=str(spec['port']))
+        if spec['threads'] is not None:
+            env['OMP_NUM_THREADS'] = str(spec['threads'])
+        processes.append(subprocess.Popen(cmd, stdout=out, stderr=subprocess.STDOUT, env=env))
+    return max(abs(p.wait()) for p in processes)
+
+
+def load_spec(args):
+    spec = OrderedDict(DEFAULTS)
+    if args.spec is not None:
+        with open(args.spec) as f:
+            spec.update(json.load(f))
+    for key in DEFAULTS:
+        value = getattr(args, key, None)
+        if value is not None and value != []:
+            spec[key] = value
+    if isinstance(spec['ranks'], str):
+        spec['ranks'] = [int(r) for r in spec['ranks'].split(',')]
+    if spec['script'] is None:
+        raise SystemExit('no script given')
+    if spec['name'] is None:
+        spec['name'] = os.path.splitext(os.path.basename(spec['script']))[0]
+    return spec
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Strong scaling sweep launcher',
+                                     usage='%(prog)s [options] script [-- script arguments]',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('script', nargs='?', default=None, help='training script')
+    parser.add_argument('--spec', default=None, help='JSON file with the sweep settings')
+    parser.add_argument('--ranks', default=None, help='comma separated rank counts (default 1,2,4,8)')
+    parser.add_argument('--ppn', type=int, default=None, help='ranks per node (default 4)')
+    parser.add_argument('--threads', type=int, default=None, help='threads (cores) per rank, with --bind (default: the launcher\'s)')
+    parser.add_argument('--bind', default=None, help='CPU binding passed to the launcher with --threads (default depth)')
+    parser.add_argument('--launcher', default=None, choices=['mpiexec', 'aprun', 'local'],
+                        help='how to start the ranks (default mpiexec)')
+    parser.add_argument('--name', default=None, help='prefix of the output files (default: script name)')
+    parser.add_argument('--outdir', default=None, help='directory for the outputs (default sweep)')
+    parser.add_argument('--dry-run', action='store_true', help='only print the commands')
+    # everything after -- goes to the training script
+    argv = sys.argv[1:]
+    script_args = []
+    if '--' in argv:
+        script_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    args = parser.parse_args(argv)
+    args.args = script_args
+    spec = load_spec(args)
+
+    if args.dry_run:
+        for ranks in spec['ranks']:
+            prefix = '' if spec['launcher'] != 'local' else '%d x ' % ranks
+            print(prefix + ' '.join(shlex.quote(c) for c in command(spec, ranks)))
+        sys.exit(0)
+
+    os.makedirs(spec['outdir'], exist_ok=True)
+    results = []
+    for ranks in spec['ranks']:
+        path = os.path.join(spec['outdir'], '%s_%d.out' % (spec['name'], ranks))
+        print('%d ranks -> %s' % (ranks, path))
+        t0 = time.time()
+        with open(path, 'w') as out:
+            status = run(spec, ranks, out)
+        record = OrderedDict([('ranks', ranks), ('command', command(spec, ranks)), ('output', path),
+                              ('returncode', status), ('wall_time', time.time() - t0)])
+        record.update(scaling_report.summarize(scaling_report.parse_log(path)))
+        # the launcher knows the number of ranks even if the script does not print it
+        record['ranks'] = ranks
+        results.append(record)
+        if status != 0:
+            print('  failed with exit status %d' % status)
+
+    with open(os.path.join(spec['outdir'], '%s_results.json' % spec['name']), 'w') as f:
+        json.dump({'spec': spec, 'runs': results}, f, indent=2)
+
+    # scripts that do not print "Total time" are compared on the wall time of the run
+    runs = []
+    for r in results:
+        if r['returncode'] == 0:
+            run_log = scaling_report.parse_log(r['output'])
+            run_log['ranks'] = r['ranks']
+            if run_log['total_time'] is None:
+                run_log['total_time'] = r['wall_time']
+            runs.append(run_log)
+    scaling_report.print_table(scaling_report.scaling_table(runs))
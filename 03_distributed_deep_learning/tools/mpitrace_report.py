@@ -0,0 +1,283 @@
+# Parse the mpitrace (libmpitrace.so) reports mpi_profile.<job>.<rank> of a job
+# into tables and compute communication statistics across the ranks:
+#
+#   python tools/mpitrace_report.py Horovod/mpitrace/cpu
+#   python tools/mpitrace_report.py Horovod/mpitrace/cpu --diff Horovod/mpitrace/gpu
+#   python tools/mpitrace_report.py Horovod/mpitrace/cpu --csv cpu   # cpu_<job>_{ranks,routines,messages,all_ranks}.csv
+#
+# The comm/elapsed statistics across ranks use the timing summary for all
+# ranks at the end of the rank 0 report when it is there, so they cover every
+# rank even when only some rank files were kept.
+from __future__ import print_function
+import os
+import re
+import csv
+import glob
+import argparse
+from collections import OrderedDict, defaultdict
+
+import numpy
+
+FILE_RE = re.compile(r'^mpi_profile\.(?P<job>\d+)\.(?P<rank>\d+)$')
+HEADER_RE = re.compile(r'^Data for MPI rank (\d+) of (\d+):')
+ROW_RE = re.compile(r'^(MPI_\w+)\s+(\d+)\s+([\d.]+)\s+([\d.]+)\s*$')
+HIST_RE = re.compile(r'^\s+(\d+)\s+([\d.]+)\s+([\d.]+)\s*$')
+HIST_HEADER_RE = re.compile(r'^(MPI_\w+)\s+#calls\s+avg\. bytes\s+time\(sec\)')
+SUMMARY_RE = {
+    'comm_time': re.compile(r'^total communication time\s*=\s*([\d.]+)'),
+    'elapsed': re.compile(r'^total elapsed time\s*=\s*([\d.]+)'),
+    'user_time': re.compile(r'^user cpu time\s*=\s*([\d.]+)'),
+    'system_time': re.compile(r'^system time\s*=\s*([\d.]+)'),
+    'max_rss_mb': re.compile(r'^max resident set size\s*=\s*([\d.]+)'),
+}
+# the timing summary for all ranks that rank 0 appends to its report
+ALL_RANKS_HEADER_RE = re.compile(r'^taskid\s+hostname\s+comm\(s\)')
+ALL_RANKS_ROW_RE = re.compile(r'^\s*(\d+)\s+(\S+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+([\d.]+)\s+(\d+)\s*$')
+
+
+class Table(object):
+    """Column oriented table: an ordered dict of column name -> list."""
+
+    def __init__(self, *columns):
+        self.columns = OrderedDict((c, []) for c in columns)
+
+    def append(self, **row):
+        for c, values in self.columns.items():
+            values.append(row[c])
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, column):
+        return numpy.asarray(self.columns[column])
+
+    def rows(self):
+        return zip(*self.columns.values())
+
+    def to_csv(self, path):
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(self.columns))
+            writer.writerows(self.rows())
+
+
+def parse_profile(path):
+    """Parse one mpi_profile file into (summary dict, routine rows, histogram rows, all ranks rows).
+
+    The all ranks rows (rank, hostname, comm, elapsed, user, system, size,
+    switches) are only in the report of rank 0, which covers every rank
+    even when the files of the other ranks are missing.
+    """
+    summary = {}
+    routines, messages, all_ranks = [], [], []
+    section = None
+    routine = None
+    with open(path) as f:
+        for line in f:
+            m = HEADER_RE.match(line)
+            if m:
+                summary['rank'], summary['nranks'] = int(m.group(1)), int(m.group(2))
+                section = 'routines'
+                continue
+            if line.startswith('Message size distributions'):
+                section = 'messages'
+                continue
+            if ALL_RANKS_HEADER_RE.match(line):
+                section = 'all_ranks'
+                continue
+            if section == 'routines':
+                m = ROW_RE.match(line)
+                if m:
+                    routines.append((m.group(1), int(m.group(2)), float(m.group(3)), float(m.group(4))))
+                    continue
+                for key, regex in SUMMARY_RE.items():
+                    m = regex.match(line)
+                    if m:
+                        summary[key] = float(m.group(1))
+            elif section == 'messages':
+                m = HIST_HEADER_RE.match(line)
+                if m:
+                    routine = m.group(1)
+                    continue
+                m = HIST_RE.match(line)
+                if m and routine is not None:
+                    messages.append((routine, int(m.group(1)), float(m.group(2)), float(m.group(3))))
+            elif section == 'all_ranks':
+                m = ALL_RANKS_ROW_RE.match(line)
+                if m:
+                    all_ranks.append((int(m.group(1)), m.group(2)) + tuple(float(v) for v in m.group(3, 4, 5, 6, 7)) +
+                                     (int(m.group(8)),))
+    return summary, routines, messages, all_ranks
+
+
+def load_jobs(paths):
+    """Collect the rank files under paths (files or directories), grouped by job id."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, 'mpi_profile.*')))
+        else:
+            files.append(path)
+    jobs = defaultdict(list)
+    for path in sorted(files):
+        m = FILE_RE.match(os.path.basename(path))
+        # skips editor backups such as #mpi_profile.<job>.<rank>#
+        if m:
+            jobs[m.group('job')].append((int(m.group('rank')), path))
+    return jobs
+
+
+def build_tables(job, rank_files):
+    ranks = Table('job', 'rank', 'nranks', 'comm_time', 'elapsed', 'user_time', 'system_time', 'max_rss_mb')
+    routines = Table('job', 'rank', 'routine', 'calls', 'avg_bytes', 'time')
+    messages = Table('job', 'rank', 'routine', 'calls', 'avg_bytes', 'time')
+    all_ranks = Table('job', 'rank', 'hostname', 'comm_time', 'elapsed', 'user_time', 'system_time', 'max_rss_mb',
+                      'switches')
+    for rank, path in sorted(rank_files):
+        summary, routine_rows, message_rows, all_ranks_rows = parse_profile(path)
+        ranks.append(job=job, rank=summary.get('rank', rank), nranks=summary.get('nranks', 0),
+                     **{k: summary.get(k, numpy.nan) for k in SUMMARY_RE})
+        for name, calls, avg_bytes, t in routine_rows:
+            routines.append(job=job, rank=rank, routine=name, calls=calls, avg_bytes=avg_bytes, time=t)
+        for name, calls, avg_bytes, t in message_rows:
+            messages.append(job=job, rank=rank, routine=name, calls=calls, avg_bytes=avg_bytes, time=t)
+        if all_ranks_rows and not len(all_ranks):
+            for row in all_ranks_rows:
+                all_ranks.append(**dict(zip(all_ranks.columns, (job,) + row)))
+    return ranks, routines, messages, all_ranks
+
+
+def imbalance(values):
+    """(max - mean) / mean, the fraction of time the slowest rank adds over the average"""
+    values = numpy.asarray(values, dtype=float)
+    mean = values.mean()
+    return (values.max() - mean) / mean if mean > 0 else 0.0
+
+
+def analyze(ranks, routines, messages, all_ranks, top=10):
+    """Statistics of a job; the per rank ones over every rank when rank 0's all ranks summary is there.
+
+    Otherwise they are over the rank files found only, and when some are
+    missing the imbalance understates the real one: 'complete' is False.
+    """
+    result = OrderedDict()
+    result['ranks_found'] = len(ranks)
+    result['nranks'] = int(ranks['nranks'].max()) if len(ranks) else 0
+    if len(all_ranks):
+        # rank 0's summary: comm and elapsed time of every rank
+        comm = all_ranks['comm_time']
+        elapsed = all_ranks['elapsed']
+        result['nranks'] = max(result['nranks'], len(all_ranks))
+    else:
+        comm = ranks['comm_time']
+        elapsed = ranks['elapsed']
+    result['ranks_summarized'] = len(comm)
+    result['complete'] = len(comm) >= result['nranks']
+    result['comm_time_mean'] = float(comm.mean())
+    result['elapsed_mean'] = float(elapsed.mean())
+    result['comm_compute_ratio'] = float(numpy.mean(comm / (elapsed - comm)))
+    result['comm_fraction'] = float(numpy.mean(comm / elapsed))
+    result['comm_time_imbalance'] = float(imbalance(comm))
+    result['elapsed_imbalance'] = float(imbalance(elapsed))
+    result['comm_time_min'] = float(comm.min())
+    result['comm_time_median'] = float(numpy.median(comm))
+    result['comm_time_max'] = float(comm.max())
+
+    # per routine: calls and time per rank and the imbalance of the time
+    per_routine = OrderedDict()
+    for name in OrderedDict.fromkeys(routines.columns['routine']):
+        sel = routines['routine'] == name
+        per_routine[name] = {'calls': float(routines['calls'][sel].mean()),
+                             'time_mean': float(routines['time'][sel].mean()),
+                             'time_imbalance': float(imbalance(routines['time'][sel]))}
+    result['routines'] = per_routine
+
+    # per (routine, message size): bandwidth and latency over all ranks
+    bins = defaultdict(lambda: [0, 0.0, 0.0])
+    for name, calls, avg_bytes, t in zip(messages.columns['routine'], messages.columns['calls'],
+                                         messages.columns['avg_bytes'], messages.columns['time']):
+        b = bins[(name, round(avg_bytes, 1))]
+        b[0] += calls
+        b[1] += calls * avg_bytes
+        b[2] += t
+    nfound = max(len(ranks), 1)
+    sizes = []
+    for (name, avg_bytes), (calls, total_bytes, t) in bins.items():
+        sizes.append({'routine': name, 'avg_bytes': avg_bytes, 'calls_per_rank': calls / float(nfound),
+                      'time_per_rank': t / nfound,
+                      'latency_us': 1e6 * t / calls if calls else 0.0,
+                      'bandwidth_mb_s': total_bytes / t / 1e6 if t > 0 else float('inf')})
+    sizes.sort(key=lambda s: (s['routine'], s['avg_bytes']))
+    result['message_sizes'] = sizes
+    result['top_collectives'] = sorted(sizes, key=lambda s: -s['time_per_rank'])[:top]
+    return result
+
+
+def print_report(job, result):
+    print('== job %s: %d of %d rank files' % (job, result['ranks_found'], result['nranks']))
+    if result['ranks_summarized'] > result['ranks_found']:
+        print('  per rank times of all %d ranks from the summary of rank 0' % result['ranks_summarized'])
+    if not result['complete']:
+        print('  warning: only %d of %d ranks, the imbalance is a lower bound' % (result['ranks_summarized'],
+                                                                              result['nranks']))
+    print('  communication time (mean)  %10.3f s' % result['comm_time_mean'])
+    print('  elapsed time (mean)        %10.3f s' % result['elapsed_mean'])
+    print('  comm / compute             %10.3f' % result['comm_compute_ratio'])
+    print('  comm fraction of elapsed   %10.1f %%' % (100 * result['comm_fraction']))
+    print('  comm time min/median/max   %10.3f %10.3f %10.3f s' % (
+        result['comm_time_min'], result['comm_time_median'], result['comm_time_max']))
+    print('  comm time imbalance        %10.1f %%' % (100 * result['comm_time_imbalance']))
+    print('  elapsed imbalance          %10.1f %%' % (100 * result['elapsed_imbalance']))
+    print('  per routine, over the %d rank files:' % result['ranks_found'])
+    print('  %-16s %12s %12s %10s' % ('routine', 'calls/rank', 'time(s)', 'imbal.'))
+    for name, r in result['routines'].items():
+        print('  %-16s %12.1f %12.3f %9.1f%%' % (name, r['calls'], r['time_mean'], 100 * r['time_imbalance']))
+    print('  top collectives by time per rank:')
+    print('  %-16s %12s %12s %12s %12s %12s' % ('routine', 'avg. bytes', 'calls/rank', 'time(s)', 'lat.(us)', 'MB/s'))
+    for s in result['top_collectives']:
+        print('  %-16s %12.1f %12.1f %12.3f %12.2f %12.2f' % (
+            s['routine'], s['avg_bytes'], s['calls_per_rank'], s['time_per_rank'], s['latency_us'], s['bandwidth_mb_s']))
+
+
+def print_diff(job_a, a, job_b, b):
+    print('== %s vs %s' % (job_a, job_b))
+    print('  %-26s %12s %12s %10s' % ('metric', job_a, job_b, 'ratio'))
+    for key in ['comm_time_mean', 'elapsed_mean', 'comm_compute_ratio', 'comm_fraction',
+                'comm_time_imbalance', 'elapsed_imbalance']:
+        ratio = b[key] / a[key] if a[key] else float('nan')
+        print('  %-26s %12.4g %12.4g %10.3f' % (key, a[key], b[key], ratio))
+    for name in OrderedDict.fromkeys(list(a['routines']) + list(b['routines'])):
+        ta = a['routines'].get(name, {}).get('time_mean', 0.0)
+        tb = b['routines'].get(name, {}).get('time_mean', 0.0)
+        ratio = tb / ta if ta else float('nan')
+        print('  %-26s %12.4g %12.4g %10.3f' % (name + ' time', ta, tb, ratio))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mpitrace profile analysis',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='mpi_profile.<job>.<rank> files or directories containing them')
+    parser.add_argument('--diff', nargs='+', default=None,
+                        help='second set of profiles (e.g. the GPU run) to compare against')
+    parser.add_argument('--top', type=int, default=10, help='number of costly collectives to list')
+    parser.add_argument('--csv', default=None, help='write <prefix>_<job>_{ranks,routines,messages,all_ranks}.csv')
+    args = parser.parse_args()
+
+    def process(paths, csv_prefix):
+        results = OrderedDict()
+        for job, rank_files in sorted(load_jobs(paths).items()):
+            tables = build_tables(job, rank_files)
+            results[job] = analyze(*tables, top=args.top)
+            print_report(job, results[job])
+            if csv_prefix is not None:
+                for name, table in zip(['ranks', 'routines', 'messages', 'all_ranks'], tables):
+                    table.to_csv('%s_%s_%s.csv' % (csv_prefix, job, name))
+        return results
+
+    results = process(args.paths, args.csv)
+    if args.diff is not None:
+        other = process(args.diff, args.csv)
+        if results and other:
+            job_a, a = list(results.items())[0]
+            job_b, b = list(other.items())[0]
+            print_diff(job_a, a, job_b, b)
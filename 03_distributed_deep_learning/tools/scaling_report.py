@@ -0,0 +1,180 @@
+# Strong scaling report from the output of 04_keras_cnn_concise_hvd.py runs
+# (results/concise_N.out): per-epoch and total times, callback overhead
+# warnings, speedup, parallel efficiency and Karp-Flatt serial fraction.
+#
+#   python tools/scaling_report.py results/concise_*.out
+#   python tools/scaling_report.py results/concise_*.out --baseline results/concise_1.out --plot scaling.png
+from __future__ import print_function
+import os
+import re
+import csv
+import json
+import argparse
+from collections import OrderedDict
+
+import numpy
+
+RANKS_RE = re.compile(r'I am rank \d+ of (\d+)')
+TOTAL_RE = re.compile(r'(?:Hvd Procs (\d+) )?Total time: ([\d.eE+-]+) second')
+# keras end of epoch line, e.g. "58/58 - 1s - loss: ..." (verbose=2) or
+# "14/14 [======] - 0s 16ms/step - loss: ..." (progress bar)
+EPOCH_RE = re.compile(r'^\s*(\d+)/(\d+) (?:\[[=>.]*\] )?- (\d+(?:\.\d+)?)(ms|s)\b(?: (\d+(?:\.\d+)?)(ms|us|s)/step)?')
+SLOW_CALLBACK_RE = re.compile(r'Callback method `(\w+)` is slow compared to the batch time '
+                              r'\(batch time: ([\d.]+)s vs `\w+` time: ([\d.]+)s\)')
+FILENAME_RE = re.compile(r'_(\d+)\.out')
+
+UNITS = {'s': 1.0, 'ms': 1e-3, 'us': 1e-6}
+
+
+def parse_log(path):
+    """Extract the number of ranks, epoch times, total time and slow callback warnings."""
+    run = OrderedDict([('file', path), ('ranks', None), ('total_time', None), ('epoch_times', []),
+                       ('step_times', []), ('steps_per_epoch', None), ('whole_seconds', False),
+                       ('slow_callbacks', [])])
+    ranks = set()
+    with open(path, newline='\n') as f:
+        for line in f:
+            m = RANKS_RE.search(line)
+            if m:
+                ranks.add(int(m.group(1)))
+                continue
+            m = TOTAL_RE.search(line)
+            if m:
+                if m.group(1):
+                    ranks.add(int(m.group(1)))
+                run['total_time'] = float(m.group(2))
+                continue
+            m = SLOW_CALLBACK_RE.search(line)
+            if m:
+                run['slow_callbacks'].append((m.group(1), float(m.group(2)), float(m.group(3))))
+                continue
+            # progress bars rewrite the line with carriage returns, keep the final state
+            m = EPOCH_RE.match(line.rstrip('\r\n').split('\r')[-1])
+            if m:
+                run['steps_per_epoch'] = int(m.group(2))
+                run['epoch_times'].append(float(m.group(3)) * UNITS[m.group(4)])
+                # keras verbose=2 prints "- 0s -": a resolution of a whole second
+                run['whole_seconds'] |= m.group(4) == 's' and '.' not in m.group(3)
+                if m.group(5):
+                    run['step_times'].append(float(m.group(5)) * UNITS[m.group(6)])
+    if ranks:
+        run['ranks'] = max(ranks)
+    else:
+        m = FILENAME_RE.search(os.path.basename(path))
+        run['ranks'] = int(m.group(1)) if m else 1
+    return run
+
+
+def summarize(run):
+    """Per-run numbers used in the table.
+
+    The first epoch line comes from the warmup fit and includes graph
+    tracing. Keras verbose=2 prints epoch times in whole seconds, so short
+    epochs read 0: then the mean epoch time is the total time (the sum of
+    the timed epochs) over the number of timed epochs, or None without a
+    total. callback_overhead is the callback time over the batch time of
+    the slow callback warnings, None when there are none with a batch time.
+    """
+    slow = [(name, b, c) for name, b, c in run['slow_callbacks'] if b > 0]
+    epochs = run['epoch_times']
+    steady = epochs[1:] if len(epochs) > 1 else epochs
+    if not steady:
+        epoch_time_mean = None
+    elif not run['whole_seconds']:
+        epoch_time_mean = float(numpy.mean(steady))
+    elif run['total_time'] is not None:
+        epoch_time_mean = run['total_time'] / len(steady)
+    else:
+        epoch_time_mean = None
+    return OrderedDict([
+        ('ranks', run['ranks']),
+        ('total_time', run['total_time']),
+        ('epochs', len(epochs)),
+        ('epoch_time_mean', epoch_time_mean),
+        ('slow_callback_warnings', len(run['slow_callbacks'])),
+        ('callback_overhead', float(numpy.mean([c / b for __, b, c in slow])) if slow else None),
+    ])
+
+
+def scaling_table(runs, baseline=None):
+    """Speedup, efficiency and Karp-Flatt serial fraction relative to the baseline run.
+
+    With a baseline on p0 ranks the ideal speedup on p ranks is q = p / p0,
+    efficiency is S / q and the Karp-Flatt metric e = (1/S - 1/q) / (1 - 1/q).
+    """
+    rows = [summarize(r) for r in runs if r['total_time'] is not None]
+    rows.sort(key=lambda r: r['ranks'])
+    if not rows:
+        return rows
+    base = summarize(baseline) if baseline is not None else rows[0]
+    for row in rows:
+        q = row['ranks'] / float(base['ranks'])
+        speedup = base['total_time'] / row['total_time']
+        row['speedup'] = speedup
+        row['efficiency'] = speedup / q
+        row['karp_flatt'] = (1.0 / speedup - 1.0 / q) / (1.0 - 1.0 / q) if q > 1 else None
+    return rows
+
+
+def print_table(rows):
+    print('%6s %10s %7s %12s %9s %11s %11s %11s %10s' % (
+        'ranks', 'total(s)', 'epochs', 'epoch(s)', 'speedup', 'efficiency', 'serial frac',
+        'cb warnings', 'cb/batch'))
+    for r in rows:
+        print('%6d %10.3f %7d %12s %9.2f %10.1f%% %11s %11d %10s' % (
+            r['ranks'], r['total_time'], r['epochs'],
+            '%.3f' % r['epoch_time_mean'] if r['epoch_time_mean'] is not None else '-',
+            r['speedup'], 100 * r['efficiency'],
+            '%.4f' % r['karp_flatt'] if r['karp_flatt'] is not None else '-',
+            r['slow_callback_warnings'],
+            '%.1f' % r['callback_overhead'] if r['callback_overhead'] is not None else '-'))
+
+
+def plot(rows, filename):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    ranks = numpy.array([r['ranks'] for r in rows])
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(10, 4))
+    ax1.plot(ranks, [r['speedup'] for r in rows], 'o-', label='measured')
+    ax1.plot(ranks, ranks / float(ranks[0]), 'k--', label='ideal')
+    ax1.set_xlabel('ranks')
+    ax1.set_ylabel('speedup')
+    ax1.legend()
+    ax2.plot(ranks, [100 * r['efficiency'] for r in rows], 'o-')
+    ax2.set_xlabel('ranks')
+    ax2.set_ylabel('parallel efficiency (%)')
+    ax2.set_ylim(0, 110)
+    for ax in (ax1, ax2):
+        ax.set_xscale('log', base=2)
+    fig.tight_layout()
+    fig.savefig(filename)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Strong scaling report from run logs',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('logs', nargs='+', help='output files of the runs')
+    parser.add_argument('--baseline', default=None, help='log of the reference run (default: fewest ranks)')
+    parser.add_argument('--csv', default=None, help='write the table to this file')
+    parser.add_argument('--json', default=None, help='write the parsed runs and the table to this file')
+    parser.add_argument('--plot', default=None, help='save speedup/efficiency plot (needs matplotlib)')
+    args = parser.parse_args()
+
+    runs = [parse_log(path) for path in args.logs]
+    baseline = parse_log(args.baseline) if args.baseline else None
+    rows = scaling_table(runs, baseline)
+    print_table(rows)
+    if args.csv and rows:
+        with open(args.csv, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'runs': runs, 'table': rows}, f, indent=2)
+    if args.plot and rows:
+        try:
+            plot(rows, args.plot)
+        except ImportError:
+            print('matplotlib is not available, skipping the plot')
@@ -0,0 +1,227 @@
+# Analyze a Horovod timeline (HOROVOD_TIMELINE=<file>.json) without loading it:
+# the Chrome-trace array is decoded one event at a time, so arbitrarily
+# large (and truncated, e.g. from a killed job) timelines can be processed.
+#
+#   python tools/timeline_report.py Horovod/HorovodTimeline/cpu.json
+#   python tools/timeline_report.py Horovod/HorovodTimeline/gpu.json --csv gpu_cycles.csv
+#
+# Every pid in the timeline is one tensor. Each allreduce cycle of a tensor
+# is a NEGOTIATE_ALLREDUCE phase (with one "X" marker per rank, named after
+# the rank, when that rank submitted the tensor) followed by an ALLREDUCE
+# phase containing QUEUE / MEMCPY_IN_FUSION_BUFFER / MPI_ALLREDUCE or
+# NCCL_ALLREDUCE / MEMCPY_OUT_FUSION_BUFFER activities. The n-th cycle of a
+# tensor is taken as step n.
+from __future__ import print_function
+import csv
+import json
+import argparse
+from collections import OrderedDict, defaultdict, Counter
+
+import numpy
+
+TOP_LEVEL = ('NEGOTIATE_ALLREDUCE', 'ALLREDUCE', 'NEGOTIATE_BROADCAST', 'BROADCAST')
+COLLECTIVES = ('MPI_ALLREDUCE', 'NCCL_ALLREDUCE', 'MPI_BCAST', 'NCCL_BCAST')
+
+
+def iter_events(path, chunk_size=1 << 20):
+    """Yield the events of a Chrome-trace JSON array one by one.
+
+    Only chunk_size characters plus one partially decoded event are held in
+    memory. A missing closing bracket (truncated file) is tolerated.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    with open(path) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            buf = buf[pos:] + chunk
+            pos = 0
+            while True:
+                # skip separators between the events
+                while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                    pos += 1
+                if not started and pos < len(buf) and buf[pos] == '[':
+                    started = True
+                    pos += 1
+                    continue
+                if pos >= len(buf) or buf[pos] == ']':
+                    break
+                try:
+                    event, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # event continues in the next chunk
+                    break
+                pos = end
+                yield event
+            if not chunk:
+                return
+
+
+class Cycle(object):
+    """ One negotiate + collective cycle of one tensor """
+    __slots__ = ('tensor', 'step', 'kind', 'negotiate_start', 'negotiate_end', 'arrivals',
+                 'start', 'end', 'phases', 'shape', 'dtype')
+
+    def __init__(self, tensor, step, kind, ts):
+        self.tensor, self.step, self.kind = tensor, step, kind
+        self.negotiate_start, self.negotiate_end = ts, None
+        self.arrivals = []
+        self.start = self.end = None
+        self.phases = defaultdict(float)
+        self.shape = self.dtype = None
+
+    def record(self):
+        arrivals = sorted(self.arrivals)
+        collective = sum(self.phases[c] for c in COLLECTIVES)
+        return OrderedDict([
+            ('tensor', self.tensor), ('step', self.step), ('kind', self.kind),
+            ('shape', self.shape), ('dtype', self.dtype),
+            ('start', self.negotiate_start), ('end', self.end),
+            ('negotiate', (self.negotiate_end or self.negotiate_start) - self.negotiate_start),
+            ('arrival_spread', arrivals[-1][0] - arrivals[0][0] if arrivals else 0),
+            ('last_rank', arrivals[-1][1] if arrivals else None),
+            ('queue', self.phases['QUEUE'] + self.phases['WAIT_FOR_DATA'] + self.phases['WAIT_FOR_OTHER_TENSOR_DATA']),
+            ('memcpy_in', self.phases['MEMCPY_IN_FUSION_BUFFER']),
+            ('memcpy_out', self.phases['MEMCPY_OUT_FUSION_BUFFER']),
+            ('collective', collective),
+            ('total', (self.end or self.negotiate_start) - self.negotiate_start),
+        ])
+
+
+def parse_timeline(path):
+    """Return (tensor names, list of cycle records) from a timeline, streaming."""
+    names = {}
+    stacks = defaultdict(list)   # pid -> open [name, ts]
+    current = {}                 # pid -> Cycle being built
+    counts = Counter()           # (pid, kind) -> cycles seen so far
+    records = []
+    for event in iter_events(path):
+        ph = event.get('ph')
+        pid = event.get('pid')
+        if ph == 'M':
+            if event.get('name') == 'process_name' and 'name' in event.get('args', {}):
+                names[pid] = event['args']['name']
+        elif ph == 'B':
+            name = event['name']
+            stacks[pid].append([name, event['ts']])
+            if name.startswith('NEGOTIATE_'):
+                kind = name[len('NEGOTIATE_'):]
+                current[pid] = Cycle(pid, counts[(pid, kind)], kind, event['ts'])
+                counts[(pid, kind)] += 1
+            elif name in TOP_LEVEL and pid in current:
+                current[pid].start = event['ts']
+        elif ph == 'E':
+            if not stacks[pid]:
+                continue
+            name, ts = stacks[pid].pop()
+            cycle = current.get(pid)
+            if cycle is None:
+                continue
+            if name.startswith('NEGOTIATE_'):
+                cycle.negotiate_end = event['ts']
+            elif name in TOP_LEVEL:
+                cycle.end = event['ts']
+                args = event.get('args', {})
+                cycle.shape, cycle.dtype = args.get('shape'), args.get('dtype')
+                records.append(cycle.record())
+                del current[pid]
+            else:
+                cycle.phases[name] += event['ts'] - ts
+        elif ph == 'X' and pid in current and current[pid].negotiate_end is None:
+            # rank markers inside the negotiation: name is the rank id
+            try:
+                current[pid].arrivals.append((event['ts'], int(event['name'])))
+            except ValueError:
+                pass
+    return names, records
+
+
+def critical_path(records):
+    """Per step: the span of all gradient cycles and the tensor finishing last.
+
+    Only tensors reduced the maximal number of times (the gradients, once per
+    step) are considered; metric and broadcast tensors are left out.
+    """
+    per_tensor = Counter(r['tensor'] for r in records if r['kind'] == 'ALLREDUCE')
+    if not per_tensor:
+        return []
+    nsteps = max(per_tensor.values())
+    grads = set(t for t, n in per_tensor.items() if n == nsteps)
+    steps = defaultdict(list)
+    for r in records:
+        if r['kind'] == 'ALLREDUCE' and r['tensor'] in grads:
+            steps[r['step']].append(r)
+    result = []
+    for step in sorted(steps):
+        cycles = steps[step]
+        last = max(cycles, key=lambda r: r['end'])
+        first = min(cycles, key=lambda r: r['start'])
+        result.append(OrderedDict([
+            ('step', step), ('span', last['end'] - first['start']),
+            ('critical_tensor', last['tensor']),
+            ('critical_negotiate', last['negotiate']), ('critical_queue', last['queue']),
+            ('critical_memcpy', last['memcpy_in'] + last['memcpy_out']),
+            ('critical_collective', last['collective']),
+            ('last_rank', last['last_rank'])]))
+    return result
+
+
+def report(names, records, top=10):
+    keys = ['negotiate', 'arrival_spread', 'queue', 'memcpy_in', 'memcpy_out', 'collective', 'total']
+    by_tensor = defaultdict(list)
+    for r in records:
+        by_tensor[(r['tensor'], r['kind'])].append(r)
+
+    print('%d cycles over %d tensors (times in microseconds, mean per cycle)' % (len(records), len(by_tensor)))
+    header = '%5s %-10s %6s %-16s' % ('pid', 'kind', 'cycles', 'shape') + ''.join('%15s' % k for k in keys)
+    print(header)
+    rows = []
+    for (tensor, kind), rs in by_tensor.items():
+        means = [numpy.mean([r[k] for r in rs]) for k in keys]
+        rows.append((tensor, kind, len(rs), rs[-1]['shape'], means))
+    rows.sort(key=lambda row: -row[4][-1] * row[2])
+    for tensor, kind, n, shape, means in rows:
+        print('%5s %-10s %6d %-16s' % (tensor, kind, n, shape) + ''.join('%15.1f' % m for m in means))
+
+    print('\nStraggling tensors (largest mean negotiation wait):')
+    for tensor, kind, n, shape, means in sorted(rows, key=lambda row: -row[4][0])[:top]:
+        print('  pid %-4s %-16s wait %10.1f us  arrival spread %10.1f us  %s' % (
+            tensor, shape, means[0], means[1], names.get(tensor, '')))
+
+    ranks = Counter(r['last_rank'] for r in records if r['last_rank'] is not None)
+    if ranks:
+        print('\nLast rank to submit a tensor (count of cycles):')
+        print('  ' + '  '.join('rank %d: %d' % (k, v) for k, v in sorted(ranks.items())))
+
+    path = critical_path(records)
+    if path:
+        spans = numpy.array([p['span'] for p in path])
+        print('\nCritical path over %d steps: communication span per step mean %.1f us, max %.1f us' % (
+            len(path), spans.mean(), spans.max()))
+        for key in ['critical_negotiate', 'critical_queue', 'critical_memcpy', 'critical_collective']:
+            print('  %-22s %10.1f us' % (key, numpy.mean([p[key] for p in path])))
+        tensors = Counter(p['critical_tensor'] for p in path)
+        print('  tensors finishing last: ' + ', '.join(
+            'pid %s (%d steps)' % (t, n) for t, n in tensors.most_common(top)))
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Horovod timeline analysis',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('timeline', help='Horovod timeline JSON file')
+    parser.add_argument('--top', type=int, default=10, help='number of tensors to list')
+    parser.add_argument('--csv', default=None, help='write one row per tensor cycle to this file')
+    parser.add_argument('--critical-path-csv', default=None, help='write one row per step to this file')
+    args = parser.parse_args()
+
+    names, records = parse_timeline(args.timeline)
+    path = report(names, records, top=args.top)
+    for filename, rows in [(args.csv, records), (args.critical_path_csv, path)]:
+        if filename is not None and rows:
+            with open(filename, 'w') as f:
+                writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+                writer.writeheader()
+                writer.writerows(rows)